@@ -0,0 +1,617 @@
+# coding=utf8
+
+import os
+import sys
+import json
+import time
+import random
+import datetime
+import resource
+import multiprocessing
+from contextlib import contextmanager
+
+import data
+from data import Util
+
+"""
+data.py 抽取性能测试, 需与data.py放在同一目录(读取同一个config.ini)
+
+python bench.py serializer [行数]
+python bench.py vectorize [行数] [块大小]    需要numpy
+python bench.py raidboss [小时数]    需要能连接config.ini中的数据库
+python bench.py fixture [日志行数] [玩家数]    在本地测试库生成合成数据, 需要config.ini中 bench_fixture = 1
+python bench.py suite [结果文件]    各unit和Extract/ConsumeExtract端到端抽取fixture数据, 结果(rows/s, 峰值RSS, SQL耗时)写入JSON
+python bench.py compare 旧结果 新结果
+python bench.py binlog [日志行数] [玩家数]    fixture数据的binlog回放与轮询输出对比, 需要本地MySQL开启ROW格式binlog, bench_fixture = 1, player_cache = 1
+"""
+
+
+class Sink(object):
+    """代替Extract, 收集unit输出"""
+    def __init__(self):
+        self.env = {
+            "clientid": "1",
+            "gameid": "2100007",
+            "start": 1792209600,
+            "datetime": datetime.datetime(2026, 10, 17, 12, 0, 0),
+            "date": "2026-10-17",
+            "time": "12:00:00",
+            "currency": "CNY",
+        }
+        self.cf = data.env["cf"]
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+
+def gold_rows(count):
+    base = datetime.datetime(2026, 10, 17, 10, 0, 0)
+    rows = []
+    for i in xrange(count):
+        playerid = random.randrange(1, 100000)
+        rows.append({
+            "playerid": playerid,
+            "uid": u"u%d" % playerid,
+            "channelid": random.choice([0, 3, 5]),
+            "num": random.randrange(-500, 500),
+            "new_num": random.randrange(0, 99999),
+            "fromid": random.randrange(1, 50),
+            "log_tm": base + datetime.timedelta(seconds=random.randrange(0, 7200)),
+            "lv": random.randrange(1, 80),
+            "vip": random.randrange(0, 10),
+        })
+    return rows
+
+
+def fill(row, delimiter='#'):
+    """data.py改为Serializer之前的模板替换, 只用于legacy_gold
+    BI_online|gameid#|snid{1}
+    BI_online|gameid{{{gameid}}}|snid{1}
+    """
+    fields = []
+    for key in row.split('|'):
+        start = key.find(delimiter)
+        if start != -1:
+            key = "{0}{{{{{{{0}}}}}}}{1}".format(key[:start], key[start + 1:])
+        fields.append(key)
+
+    return "|".join(fields)
+
+
+def legacy_gold(unit, common, rows):
+    """data.py改为Serializer之前的逐行 fill + format(**common)"""
+    for gold in rows:
+        if gold["num"] >= 0:
+            common["openid"] = gold["uid"]
+            common["get_timestamp"] = Util.datetime_timestamp(gold["log_tm"])
+            common["get_date"] = gold["log_tm"].date()
+            common["get_time"] = gold["log_tm"].time()
+            common["level"] = gold["lv"]
+            common["vip_level"] = gold["vip"]
+            common["roleid"] = gold["playerid"]
+            common["snid"] = unit.get_snid(gold["channelid"])
+            common["get_wayid"] = gold["fromid"]
+            common["get_wayclassid"] = gold["fromid"]
+            common["gold_sum"] = gold["num"]
+            common["gold_total"] = gold["new_num"]
+            row_goldget = fill("BI_gold_get|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|gold_sum#|gold_total#|poundage#|get_wayid#|get_wayclassid#|get_timestamp#|get_date#|get_time#|extend_1#|extend_2#\n")
+            unit.write(row_goldget.format(**common))
+        else:
+            common["openid"] = gold["uid"]
+            common["consume_timestamp"] = Util.datetime_timestamp(gold["log_tm"])
+            common["consume_date"] = gold["log_tm"].date()
+            common["consume_time"] = gold["log_tm"].time()
+            common["level"] = gold["lv"]
+            common["vip_level"] = gold["vip"]
+            common["roleid"] = gold["playerid"]
+            common["snid"] = unit.get_snid(gold["channelid"])
+            common["consume_wayid"] = gold["fromid"]
+            common["consume_wayclassid"] = gold["fromid"]
+            common["gold_sum"] = gold["num"]
+            common["gold_total"] = gold["new_num"]
+            common["goodsid"] = gold["fromid"]
+            common["goodsprice"] = gold["num"]
+            common["goodsnum"] = 1
+            row_goldconsume = fill("BI_gold_consume|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|gold_sum#|gold_total#|poundage#|consume_wayid#|consume_wayclassid#|goodsid#|goodsprice#|goodsnum#|consume_timestamp#|consume_date#|consume_time#|extend_1#|extend_2#\n")
+            unit.write(row_goldconsume.format(**common))
+
+
+def serializer_gold(unit, common, rows):
+    unit.prepare(common)
+    unit.emit_source(unit.SOURCES[0], rows)
+
+
+def gold_common(env):
+    common = dict(env)
+    common["IP"] = ""
+    common["poundage"] = 0
+    common["extend_1"] = ""
+    common["extend_2"] = ""
+    return common
+
+
+def bench_serializer(count=200000):
+    """BI_gold_get/BI_gold_consume: 旧的fill + format(**common) 与 Serializer 对比, 并校验输出一致"""
+    random.seed(1)
+    rows = gold_rows(count)
+    result = {}
+    for name, func in (("legacy", legacy_gold), ("serializer", serializer_gold)):
+        sink = Sink()
+        unit = data.Gold(sink)
+        start = time.time()
+        func(unit, gold_common(sink.env), rows)
+        use = time.time() - start
+        result[name] = (use, sink.lines)
+        print("{0:<12} {1} rows, {2:.3f}s, {3:.0f} rows/s".format(name, count, use, count / use))
+
+    identical = "".join(result["legacy"][1]) == "".join(result["serializer"][1])
+    print("speedup: {0:.2f}x, byte identical: {1}".format(result["legacy"][0] / result["serializer"][0], identical))
+    return identical
+
+
+def bench_vectorize(count=200000, block_rows=8192):
+    """log_gold: 逐行 Util.datetime_timestamp/.date()/.time() + render 与 Block按块格式化 对比, 并校验输出一致"""
+    random.seed(1)
+    rows = [data.torndb.Row(row) for row in gold_rows(count)]
+    result = {}
+    for name in ("row", "block"):
+        sink = Sink()
+        unit = data.Gold(sink)
+        unit.prepare(gold_common(sink.env))
+        start = time.time()
+        if name == "row":
+            unit.emit_source(unit.SOURCES[0], rows)
+        else:
+            for chunk in Util.chunks(rows, block_rows):
+                unit.emit_source_block(unit.SOURCES[0], data.Block(chunk, unit.config_get("default_snid")))
+        use = time.time() - start
+        result[name] = (use, "".join(sink.lines))
+        print("{0:<8} {1} rows, {2:.3f}s, {3:.0f} rows/s".format(name, count, use, count / use))
+
+    identical = result["row"][1] == result["block"][1]
+    print("speedup: {0:.2f}x, byte identical: {1}".format(result["row"][0] / result["block"][0], identical))
+    return identical
+
+
+RAIDBOSS_UNION = "select uid1 as uid, start_tm, stage_key, start_tm, result from {db_log}.log_raidboss where start_tm >= '{mission_start}' and start_tm < '{start_datetime}' and uid1 is not null and  uid1 != 0 union all select uid2 as uid, start_tm, stage_key, start_tm, result from {db_log}.log_raidboss where start_tm >= '{mission_start}' and start_tm < '{start_datetime}' and uid2 is not null and  uid2 != 0 union all select uid3 as uid, start_tm, stage_key, start_tm, result from {db_log}.log_raidboss where start_tm >= '{mission_start}' and start_tm < '{start_datetime}' and uid3 is not null and  uid3 != 0 union all select uid4 as uid, start_tm, stage_key, start_tm, result from {db_log}.log_raidboss where start_tm >= '{mission_start}' and start_tm < '{start_datetime}' and uid4 is not null and  uid4 != 0"
+
+
+def handler_reads(db):
+    return sum(int(row["Value"]) for row in db.query("show session status like 'Handler_read%%'"))
+
+
+def bench_raidboss(hours=24):
+    """log_raidboss: 原来的4次union all 与 单次扫描+客户端展开 对比扫描行数(Handler_read*), 并校验记录一致"""
+    end = int(time.time())
+    common = {
+        "db_log": data.config_option("db_log"),
+        "mission_start": Util.timestamp_datetime(end - hours * 3600),
+        "start_datetime": Util.timestamp_datetime(end),
+    }
+    slots = data.Mission.RAIDBOSS_SLOTS
+
+    result = {}
+    # Handler_read*是会话级的, 两次查询在连接池的同一个连接上执行
+    with data.Connection.create(data.SERVER_LEVEL).pool.connection() as db:
+        for name, sql in (("union", RAIDBOSS_UNION.format(**common)), ("single", data.Mission.raidboss_sql(common))):
+            reads = handler_reads(db)
+            start = time.time()
+            records = []
+            rows = 0
+            for boss in db.iter(sql):
+                rows += 1
+                if name == "union":
+                    records.append((boss["uid"], boss["start_tm"], boss["stage_key"], boss["result"]))
+                else:
+                    records.extend((boss[slot], boss["start_tm"], boss["stage_key"], boss["result"]) for slot in slots if boss[slot] is not None)
+            use = time.time() - start
+            scanned = handler_reads(db) - reads
+            result[name] = (scanned, sorted(records))
+            print("{0:<8} rows sent: {1}, records: {2}, rows scanned: {3}, {4:.3f}s".format(name, rows, len(records), scanned, use))
+
+    identical = result["union"][1] == result["single"][1]
+    print("rows scanned: {0:.2f}x less, same records: {1}".format(float(result["union"][0]) / max(result["single"][0], 1), identical))
+    if not result["union"][1]:
+        print("no raidboss records in the last {0} hours, nothing compared".format(hours))
+        return False
+    return identical
+
+
+FIXTURE_TABLES = [
+    # (库名配置项, 表名, 级别, 占日志总行数的比例, 建表语句)
+    ("db_log", "log_login", data.SERVER_LEVEL, 10, "id bigint auto_increment primary key, playerid int, uid varchar(64), channelid int, login_ip varchar(32), login_tm datetime, key(login_tm)"),
+    ("db_log", "log_jewel", data.SERVER_LEVEL, 10, "id bigint auto_increment primary key, playerid int, uid varchar(64), channelid int, num int, new_num int, fromid int, log_tm datetime, key(log_tm)"),
+    ("db_log", "log_gold", data.SERVER_LEVEL, 25, "id bigint auto_increment primary key, playerid int, uid varchar(64), channelid int, num int, new_num int, fromid int, log_tm datetime, key(log_tm)"),
+    ("db_log", "log_badge", data.SERVER_LEVEL, 5, "id bigint auto_increment primary key, playerid int, uid varchar(64), channelid int, num int, new_num int, fromid int, log_tm datetime, key(log_tm)"),
+    ("db_log", "log_guild_coin", data.SERVER_LEVEL, 5, "id bigint auto_increment primary key, playerid int, uid varchar(64), channelid int, num int, new_num int, fromid int, guildid int, log_tm datetime, key(log_tm)"),
+    ("db_log", "log_get_card", data.SERVER_LEVEL, 10, "id bigint auto_increment primary key, playerid int, uid varchar(64), channelid int, card_key varchar(32), num int, fromid int, get_tm datetime, key(get_tm)"),
+    ("db_log", "log_get_equip", data.SERVER_LEVEL, 5, "id bigint auto_increment primary key, playerid int, uid varchar(64), channelid int, equip_key varchar(32), num int, fromid int, get_tm datetime, key(get_tm)"),
+    ("db_log", "log_get_medal", data.SERVER_LEVEL, 5, "id bigint auto_increment primary key, playerid int, uid varchar(64), channelid int, medal_key varchar(32), fromid varchar(32), from_mapid int, from_stageid int, num int, new_num int, log_tm datetime, key(log_tm)"),
+    ("db_log", "log_use_equip", data.SERVER_LEVEL, 5, "id bigint auto_increment primary key, playerid int, uid varchar(64), channelid int, equip_key varchar(32), fromid int, log_tm datetime, key(log_tm)"),
+    ("db_log", "log_use_medal", data.SERVER_LEVEL, 5, "id bigint auto_increment primary key, playerid int, uid varchar(64), channelid int, medal_key varchar(32), cardid int, num int, new_num int, log_tm datetime, key(log_tm)"),
+    ("db_log", "log_pve", data.SERVER_LEVEL, 10, "id bigint auto_increment primary key, playerid int, uid varchar(64), channelid int, pve_tm datetime, typeid int, stageid int, mapid int, key(pve_tm)"),
+    ("db_log", "log_raidboss", data.SERVER_LEVEL, 3, "id bigint auto_increment primary key, uid1 varchar(64), uid2 varchar(64), uid3 varchar(64), uid4 varchar(64), start_tm datetime, stage_key varchar(32), result int, key(start_tm)"),
+    ("db_login", "helix_order", data.GAME_LEVEL, 2, "id bigint auto_increment primary key, platformid int, gsid int, channelid int, uid varchar(64), playerid int, money int, jewel int, sdk_orderid varchar(64), createtm datetime, order_result int, feed_result int, key(createtm)"),
+]
+PLAYER_TABLE = "playerid int primary key, uid varchar(64), channelid int, lv int, vip int, playername varchar(64), myguildid int, createtm int, lastoptm int, key(uid), key(createtm)"
+WATERMARKS = ("login_start", "payment_start", "register_start", "consume_start", "mission_start", "gold_start", "other_start", "props_start")
+
+
+class Fixture(object):
+    """合成的区服数据, 写入config.ini中的db_game/db_log/db_login(本地MySQL)
+    日志时间均匀分布在 [end - hours小时, end), 约10%的玩家在这段时间内创建
+    """
+    def __init__(self, rows, players, hours=24, batch=2000):
+        self.rows = rows
+        self.players = players
+        self.end = int(time.time()) // 3600 * 3600
+        self.begin = self.end - hours * 3600
+        self.batch = batch
+        self.clientid = int(data.config_option("clientid"))
+
+    def log_tm(self):
+        return Util.timestamp_datetime(random.randrange(self.begin, self.end), strf=False)
+
+    @classmethod
+    def uid(cls, playerid):
+        """uid为数字字符串, 同线上; 非数字开头的字符串在MySQL中 != 0 为假, log_raidboss的记录会全部被过滤"""
+        return "%d" % (100000000 + playerid)
+
+    def player(self):
+        """日志中约1%的玩家不在helix_player中"""
+        playerid = random.randrange(1, int(self.players * 1.01) + 1)
+        return playerid, self.uid(playerid), random.choice((0, 3, 5))
+
+    def player_rows(self):
+        for playerid in xrange(1, self.players + 1):
+            new = random.random() < 0.1
+            createtm = random.randrange(self.begin, self.end) if new else self.begin - random.randrange(1, 90 * 86400)
+            yield (playerid, self.uid(playerid), random.choice((0, 3, 5)), random.randrange(1, 80), random.randrange(0, 10), u"玩家%d" % playerid,
+                   random.randrange(0, 500), createtm, random.randrange(max(createtm, self.begin), self.end))
+
+    def log_rows(self, table, count):
+        """table的count行, 不含自增id"""
+        for i in xrange(count):
+            playerid, uid, channelid = self.player()
+            if table == "log_login":
+                yield (playerid, uid, channelid, "10.0.%d.%d" % (i // 256 % 256, i % 256), self.log_tm())
+            elif table in ("log_jewel", "log_gold", "log_badge"):
+                yield (playerid, uid, channelid, random.randrange(-500, 500), random.randrange(0, 99999), random.randrange(1, 50), self.log_tm())
+            elif table == "log_guild_coin":
+                yield (playerid, uid, channelid, random.randrange(-500, 500), random.randrange(0, 99999), random.randrange(1, 50), random.randrange(1, 500), self.log_tm())
+            elif table in ("log_get_card", "log_get_equip"):
+                yield (playerid, uid, channelid, "k%d" % random.randrange(500), random.randrange(0, 5), random.randrange(1, 30), self.log_tm())
+            elif table == "log_get_medal":
+                yield (playerid, uid, channelid, "m%d" % random.randrange(200), random.choice(("bind", "unbind")), random.randrange(1, 30), random.randrange(1, 100),
+                       random.randrange(0, 5), random.randrange(0, 999), self.log_tm())
+            elif table == "log_use_equip":
+                yield (playerid, uid, channelid, "k%d" % random.randrange(500), random.randrange(1, 30), self.log_tm())
+            elif table == "log_use_medal":
+                yield (playerid, uid, channelid, "m%d" % random.randrange(200), random.randrange(1, 1000), random.randrange(1, 5), random.randrange(0, 999), self.log_tm())
+            elif table == "log_pve":
+                yield (playerid, uid, channelid, self.log_tm(), random.randrange(1, 4), random.randrange(1, 100), random.randrange(1, 30))
+            elif table == "log_raidboss":
+                # 空位为NULL或'0'
+                slots = [self.player()[1] for _ in xrange(4)]
+                for slot in xrange(random.randrange(0, 3)):
+                    slots[3 - slot] = random.choice((None, "0"))
+                yield tuple(slots) + (self.log_tm(), "s%d" % random.randrange(50), random.randrange(0, 2))
+            elif table == "helix_order":
+                yield (1, self.clientid, channelid, uid, playerid, 6, 60, "bench%d" % i, self.log_tm(), 1, 0 if random.random() < 0.05 else 1)
+
+    def load(self, db, table, ddl, rows):
+        self.create(db, table, ddl)
+        return self.insert(db, table, ddl, rows)
+
+    def create(self, db, table, ddl):
+        db.execute("drop table if exists {0}".format(table))
+        db.execute("create table {0}({1}) default charset=utf8mb4".format(table, ddl))
+
+    def insert(self, db, table, ddl, rows):
+        count = 0
+        columns = [column.split()[0] for column in ddl.split(", ") if not column.startswith("key(") and "auto_increment" not in column]
+        sql = "insert into {0}({1}) values({2})".format(table, ", ".join(columns), ", ".join(["%s"] * len(columns)))
+        start = time.time()
+        for chunk in Util.chunks(rows, self.batch):
+            db.executemany(sql, chunk)
+            count += len(chunk)
+        print("{0:<28} {1:>10} rows, {2:.1f}s".format(table, count, time.time() - start))
+        return count
+
+    def generate(self):
+        result = {"begin": self.begin, "end": self.end, "players": self.players, "tables": {}}
+        db_game = data.config_option("db_game")
+        with self.database(data.SERVER_LEVEL, db_game) as db:
+            self.load(db, "{0}.helix_player".format(db_game), PLAYER_TABLE, self.player_rows())
+        weights = float(sum(table[3] for table in FIXTURE_TABLES))
+        for db_name, table, level, weight, ddl in FIXTURE_TABLES:
+            name = data.env["cf"].get(level, db_name)
+            with self.database(level, name) as db:
+                result["tables"][table] = self.load(db, "{0}.{1}".format(name, table), ddl, self.log_rows(table, int(self.rows * weight / weights)))
+        return result
+
+    def replay(self):
+        """binlog回放用的fixture: 重建各表, 写入fixture开始前创建的玩家, 返回之后写入数据的binlog位置
+        位置之后写入新玩家, 各日志表, 以及一半未支付订单的支付(feed_result 0 -> 1)
+        """
+        db_game = data.config_option("db_game")
+        players = list(self.player_rows())
+        tables = [(data.SERVER_LEVEL, db_game, "helix_player", PLAYER_TABLE)]
+        tables += [(level, data.env["cf"].get(level, db_name), table, ddl) for db_name, table, level, weight, ddl in FIXTURE_TABLES]
+        for level, name, table, ddl in tables:
+            with self.database(level, name) as db:
+                self.create(db, "{0}.{1}".format(name, table), ddl)
+        with self.database(data.SERVER_LEVEL, db_game) as db:
+            # createtm是第8列
+            self.insert(db, "{0}.helix_player".format(db_game), PLAYER_TABLE, (player for player in players if player[7] < self.begin))
+            status = db.get("show master status")
+            self.insert(db, "{0}.helix_player".format(db_game), PLAYER_TABLE, (player for player in players if player[7] >= self.begin))
+        weights = float(sum(table[3] for table in FIXTURE_TABLES))
+        for db_name, table, level, weight, ddl in FIXTURE_TABLES:
+            name = data.env["cf"].get(level, db_name)
+            with self.database(level, name) as db:
+                self.insert(db, "{0}.{1}".format(name, table), ddl, self.log_rows(table, int(self.rows * weight / weights)))
+        db_login = data.env["cf"].get(data.GAME_LEVEL, "db_login")
+        with self.database(data.GAME_LEVEL, db_login) as db:
+            db.execute("update {0}.helix_order set feed_result=1 where feed_result=0 and mod(id, 2)=0".format(db_login))
+        return status["File"], int(status["Position"])
+
+    @contextmanager
+    def database(self, level, name):
+        with data.Connection.create(level).pool.connection() as db:
+            db.execute("create database if not exists {0} default charset utf8mb4".format(name))
+            yield db
+
+
+def bench_fixture(rows=1000000, players=None):
+    """生成合成数据, 会删除并重建各表, 只能用于设置了 bench_fixture = 1 的测试库"""
+    if data.config_option("bench_fixture", "0") != "1":
+        print("refuse to drop tables: set bench_fixture = 1 in config.ini of a local test database")
+        return False
+    random.seed(1)
+    fixture = Fixture(rows, players or max(1000, rows // 200))
+    result = fixture.generate()
+    print("window: {0} ~ {1}, players: {2}".format(Util.timestamp_datetime(result["begin"]), Util.timestamp_datetime(result["end"]), result["players"]))
+    return True
+
+
+def fixture_window():
+    """fixture数据的时间范围, 由log_gold的最早和最晚时间得到"""
+    row = data.Connection.create(data.SERVER_LEVEL).get("select min(log_tm) as begin, max(log_tm) as end from {0}.log_gold".format(data.config_option("db_log")))
+    begin = Util.datetime_timestamp(row["begin"]) // 3600 * 3600
+    end = (Util.datetime_timestamp(row["end"]) // 3600 + 1) * 3600
+    data.Connection.close_all()
+    return begin, end
+
+
+def query_stats(metrics, unit):
+    """unit的SQL次数, 总耗时和耗时分布(累计桶)"""
+    histogram = metrics.histograms.get((("unit", unit),))
+    if histogram is None:
+        return {"count": 0, "seconds": 0.0, "buckets": {}}
+    return {"count": histogram[-2], "seconds": histogram[-1], "buckets": dict((repr(bound), count) for bound, count in zip(data.Metrics.BUCKETS, histogram))}
+
+
+def remove_output(extract):
+    """性能测试不保留输出文件"""
+    for name in (extract.filename, extract.filename[:-len(".tmp")]):
+        path = os.path.join(extract.dst, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def reset_checkpoint(begin):
+    """进度重置到begin, 清空已输出的键"""
+    checkpoint = data.Checkpoint.open(data.config_option("checkpoint_path", os.path.join(data.env["cwd"], "checkpoint.db")), data.env["cf"])
+    checkpoint.update(dict((name, begin) for name in WATERMARKS))
+    with checkpoint.lock:
+        checkpoint.db.execute("delete from seen")
+
+
+def run_phase(extract_name, unit_name, begin, end):
+    """在子进程中执行, 峰值RSS只包含本阶段; unit_name为None时端到端执行extract.run()"""
+    extract_cls = getattr(data, extract_name)
+    reset_checkpoint(begin)
+    extract = extract_cls(end)
+    result = {"phase": "{0}/{1}".format(extract_name, unit_name or "run"), "error": None}
+    try:
+        start = time.time()
+        if unit_name is None:
+            extract.run()
+            units = extract.units
+            output_bytes = extract.file_bytes
+        else:
+            extract.refresh_players()
+            start = time.time()
+            units = [unit for unit in extract.units if unit.name() == unit_name]
+            extract.reopen()
+            error = extract.flush_unit(extract.run_unit(units[0]))
+            extract.close()
+            output_bytes = extract.file_bytes
+            if error is not None:
+                result["error"] = str(error[0])
+        use = time.time() - start
+    finally:
+        remove_output(extract)
+        data.Connection.close_all()
+    rows = sum(unit.rows for unit in units)
+    result.update({
+        "rows": rows,
+        "seconds": use,
+        "rows_per_second": rows / use if use else 0.0,
+        "bytes": output_bytes,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "queries": dict((unit.name(), query_stats(extract.metrics, unit.name())) for unit in units),
+        "slow_queries": [{"seconds": seconds, "unit": unit, "sql": sql} for seconds, unit, sql in sorted(extract.metrics.slow, reverse=True)],
+    })
+    return result
+
+
+def bench_suite(output="bench_result.json"):
+    """每个unit和Extract/ConsumeExtract端到端抽取fixture数据(每个阶段一个子进程, 进度重置到fixture开始时间)
+    结果写入JSON文件, 用 python bench.py compare 比较两个版本
+    """
+    if data.config_option("bench_fixture", "0") != "1":
+        print("refuse to reset checkpoint: set bench_fixture = 1 in config.ini of a local test database")
+        return False
+    begin, end = fixture_window()
+    phases = []
+    for extract_name in ("Extract", "ConsumeExtract"):
+        extract = getattr(data, extract_name)(end)
+        remove_output(extract)
+        phases.extend((extract_name, unit.name()) for unit in extract.units)
+        phases.append((extract_name, None))
+
+    results = []
+    ok = True
+    for extract_name, unit_name in phases:
+        # maxtasksperchild=1: 每个阶段新的进程, 峰值RSS互不影响
+        worker = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            result = worker.apply(run_phase, (extract_name, unit_name, begin, end))
+        finally:
+            worker.close()
+            worker.join()
+        ok = ok and result["error"] is None
+        results.append(result)
+        print("{phase:<24} {rows:>10} rows, {seconds:8.2f}s, {rows_per_second:10.0f} rows/s, peak rss {peak_rss_kb} KB".format(**result))
+
+    report = {
+        "version": 1,
+        "time": int(time.time()),
+        "window": [begin, end],
+        "config": dict((key, data.config_option(key)) for key in ("workers", "fetch_size", "player_cache", "vectorize", "output_format", "compress")),
+        "phases": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("result: {0}".format(output))
+    return ok
+
+
+
+def bench_compare(old, new):
+    """比较两次suite结果的rows/s, 下降超过10%的阶段返回失败"""
+    with open(old) as f:
+        before = dict((phase["phase"], phase) for phase in json.load(f)["phases"])
+    with open(new) as f:
+        after = json.load(f)["phases"]
+    ok = True
+    for phase in after:
+        base = before.get(phase["phase"])
+        if base is None or not base["rows_per_second"]:
+            continue
+        ratio = phase["rows_per_second"] / base["rows_per_second"]
+        regressed = ratio < 0.9
+        ok = ok and not regressed
+        print("{0:<24} {1:10.0f} -> {2:10.0f} rows/s, {3:.2f}x, rss {4} -> {5} KB{6}".format(
+            phase["phase"], base["rows_per_second"], phase["rows_per_second"], ratio, base["peak_rss_kb"], phase["peak_rss_kb"], " REGRESSION" if regressed else ""))
+    return ok
+
+
+def read_output(extract):
+    """已关闭的输出文件中的记录, 读完删除"""
+    with open(os.path.join(extract.dst, extract.filename)) as f:
+        lines = f.readlines()
+    remove_output(extract)
+    return lines
+
+
+def binlog_records(log_file, log_pos):
+    """从log_file:log_pos读到binlog当前末尾, 返回BinlogExtract输出的记录, 不保存binlog位置"""
+    binlog = data.Binlog()
+    # 全量刷新, 缓存文件可能是上一次fixture的
+    binlog.players.full_tm = 0
+    binlog.players.refresh(int(time.time()))
+    extract = binlog.open()
+    stream = binlog.stream(extract, log_file, log_pos, blocking=False)
+    try:
+        for event in stream:
+            binlog.dispatch(extract, event)
+    finally:
+        stream.close()
+    for unit in extract.units:
+        unit.flush_columnar()
+    extract.close()
+    return read_output(extract)
+
+
+def poll_records(end):
+    """轮询方式抽取有binlog处理方法的unit, 不使用玩家缓存(连接helix_player), 返回输出的记录"""
+    cf = data.env["cf"]
+    player_cache = data.config_option("player_cache", "0")
+    cf.set(data.SERVER_LEVEL, "player_cache", "0")
+    lines = []
+    try:
+        for extract_name in ("Extract", "ConsumeExtract"):
+            # payment抽取到 start - 300
+            extract = getattr(data, extract_name)(end + 300)
+            extract.reopen()
+            for unit in extract.units:
+                if unit.BINLOG:
+                    error = extract.flush_unit(extract.run_unit(unit))
+                    if error is not None:
+                        raise error[0]
+            extract.close()
+            lines.extend(read_output(extract))
+    finally:
+        cf.set(data.SERVER_LEVEL, "player_cache", player_cache)
+    return lines
+
+
+def bench_binlog(rows=20000, players=None):
+    """binlog回放校验: 记下binlog位置后写入fixture数据, binlog模式与轮询抽取同一批数据, 比较输出的BI_记录
+    覆盖binlog_order的支付状态变化, binlog_raidboss的空位, binlog_pve的uid检查等各binlog处理方法
+    """
+    if data.config_option("bench_fixture", "0") != "1":
+        print("refuse to drop tables: set bench_fixture = 1 in config.ini of a local test database")
+        return False
+    if data.BinLogStreamReader is None:
+        print("binlog replay need python package mysql-replication")
+        return False
+    if data.config_option("output_format", "text") != "text" or data.config_option("compress", "none") != "none":
+        print("binlog replay compares text output: set output_format = text, compress = none")
+        return False
+    random.seed(1)
+    fixture = Fixture(rows, players or max(1000, rows // 20))
+    log_file, log_pos = fixture.replay()
+    reset_checkpoint(fixture.begin)
+    replayed = binlog_records(log_file, log_pos)
+    reset_checkpoint(fixture.begin)
+    polled = poll_records(fixture.end)
+    data.Connection.close_all()
+
+    counts = {}
+    for name, lines in (("poll", polled), ("binlog", replayed)):
+        for line in lines:
+            record_type = line.split("|", 1)[0]
+            counts.setdefault(record_type, {"poll": 0, "binlog": 0})[name] += 1
+    for record_type, count in sorted(counts.items()):
+        print("{0:<20} poll: {1:>8}, binlog: {2:>8}".format(record_type, count["poll"], count["binlog"]))
+    identical = sorted(polled) == sorted(replayed)
+    print("same records: {0}".format(identical))
+    if not polled:
+        print("no records, nothing compared")
+        return False
+    return identical
+
+
+def main():
+    benches = {
+        "serializer": bench_serializer,
+        "raidboss": bench_raidboss,
+        "vectorize": bench_vectorize,
+        "fixture": bench_fixture,
+        "suite": bench_suite,
+        "compare": bench_compare,
+        "binlog": bench_binlog,
+    }
+    name = sys.argv[1] if len(sys.argv) > 1 else "serializer"
+    args = [arg if name in ("suite", "compare") else int(arg) for arg in sys.argv[2:]]
+    if not benches[name](*args):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
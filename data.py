@@ -1,17 +1,56 @@
 # coding=utf8
 
 import os
+import re
 import sys
 import time
 import random
+import gzip
+import zlib
+import shutil
+import struct
 import logging
 import datetime
+import tempfile
+import itertools
+import threading
 import traceback
+import cPickle
+import sqlite3
+import heapq
+import json
 import ConfigParser
 from logging import handlers
 from functools import wraps, partial
+from operator import itemgetter
+from multiprocessing.pool import ThreadPool
 
 import torndb
+import MySQLdb.cursors
+
+import pool
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from pymysqlreplication import BinLogStreamReader
+    from pymysqlreplication.event import QueryEvent, XidEvent, HeartbeatLogEvent
+    from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent
+except ImportError:
+    BinLogStreamReader = None
 
 
 """
@@ -44,6 +83,7 @@ mission：log_pve(typeid类别，等同于mission_level、stageid关卡id， 都
 
 GAME_LEVEL = "game"      # game级别
 SERVER_LEVEL = "server"  # server级别
+TIME_ZONE = ("+8:00", 8 * 3600)     # 数据库连接的时区和偏移秒数, 时间戳与日期时间按这个固定偏移换算(无夏令时)
 
 log = logging.getLogger("bi")
 env = None
@@ -62,6 +102,13 @@ def log_init(filename):
     log.setLevel(logging.DEBUG)
 
 
+def load_env(config_path):
+    """读取区服的配置文件, 工作目录为配置文件所在目录"""
+    cf = ConfigParser.ConfigParser()
+    cf.read(config_path)
+    return dict(cwd=os.path.dirname(config_path), cf=cf, config_path=config_path)
+
+
 def env_init():
     # 获取工作目录
     filename = sys.argv[0].rsplit(os.path.sep, 1)
@@ -71,21 +118,26 @@ def env_init():
         cwd = os.path.realpath(os.getcwd())
 
     # 获取配置文件
-    cf = ConfigParser.ConfigParser()
-    config_path = os.path.join(cwd, "config.ini")
-    cf.read(config_path)
+    env = load_env(os.path.join(cwd, "config.ini"))
 
     # 初始化日志
-    filename = cf.get(SERVER_LEVEL, "log")
+    filename = env["cf"].get(SERVER_LEVEL, "log")
     log_init(filename)
 
-    env = dict(cwd=cwd, cf=cf, config_path=config_path)
-
     return env
 
 env = env_init()
 
 
+def config_option(key, default=None, level=SERVER_LEVEL, cf=None):
+    """读取可选配置, 没有配置时返回默认值, cf默认为本进程的config.ini"""
+    if cf is None:
+        cf = env["cf"]
+    if cf.has_option(level, key):
+        return cf.get(level, key)
+    return default
+
+
 def log_level(level):
     """记录日志"""
     assert level in ("debug", "info", "warn", "error")
@@ -106,77 +158,1190 @@ def log_level(level):
 
 
 class Connection(object):
-    CONNECTIONS = {}
+    POOLS = {}      # 数据库地址 -> Connection, 进程内所有线程共用
+    LOCK = threading.Lock()
+    ROUTES = {}     # (区服配置, 级别) -> 上次选择的地址, 变化时记录日志
+
+    @classmethod
+    def create(cls, level=SERVER_LEVEL, cf=None, host=None):
+        """远程服还是本地服
+        每次查询都从连接池取连接, 流式读取未结束时查询其他数据会自动使用另一个连接
+        cf: 区服配置, 默认为本进程的config.ini; 相同数据库地址的区服共用连接池(查询中的库名都是完整的)
+        host: 从库地址, 默认为level的host(主库), 用户名密码与主库相同
+        连接池参数读取本进程的config.ini: pool_max_idle, pool_ping_interval, pool_retries
+        """
+        if cf is None:
+            cf = env["cf"]
+        get = partial(cf.get, level)
+        key = (host or get("host"), get("user"), get("db_default"))
+        with cls.LOCK:
+            if key not in cls.POOLS:
+                log.warning("mysql pool init, level: %s, host: %s", level, key[0])
+                factory = partial(torndb.Connection, key[0], get("db_default"), user=get("user"), password=get("password"), time_zone=TIME_ZONE[0])
+                connection_pool = pool.Pool(factory, int(config_option("pool_max_idle", 4)), int(config_option("pool_ping_interval", 300)),
+                                            int(config_option("pool_retries", 1)), key[0])
+                cls.POOLS[key] = cls(connection_pool, level, cf)
+            return cls.POOLS[key]
+
+    @classmethod
+    def replicas(cls, level, cf):
+        replicas = cf.get(level, "replicas") if cf.has_option(level, "replicas") else ""
+        return [host.strip() for host in replicas.split(",") if host.strip()]
 
     @classmethod
-    def create(cls, level=SERVER_LEVEL):
-        """远程服还是本地服 """
-        if level not in cls.CONNECTIONS:
-            get = partial(env["cf"].get, level)
-            log.warning("mysql connection init, level: %s", level)
-            conn = torndb.Connection(get("host"), get("db_default"), user=get("user"), password=get("password"), time_zone="+8:00")
-            cls.CONNECTIONS[level] = cls(conn)
-        return cls.CONNECTIONS[level]
-
-    def __init__(self, conn):
-        self.conn = conn
+    def created(cls, cf):
+        """区服各级别的主库和从库中已创建的连接池, 可能是由地址相同的其他区服创建的"""
+        keys = set()
+        for level in (SERVER_LEVEL, GAME_LEVEL):
+            if not cf.has_section(level):
+                continue
+            get = partial(cf.get, level)
+            for host in [get("host")] + cls.replicas(level, cf):
+                keys.add((host, get("user"), get("db_default")))
+        with cls.LOCK:
+            return [cls.POOLS[key] for key in sorted(keys) if key in cls.POOLS]
+
+    @classmethod
+    def route(cls, level=SERVER_LEVEL, cf=None, window_end=None):
+        """只读查询的连接: level配置了replicas(逗号分隔的从库地址)时, 选择延迟最小且已复制到window_end的从库
+        允许的延迟 = 当前时间 - window_end - replica_lag_margin秒, 没有满足的从库时使用主库
+        """
+        if cf is None:
+            cf = env["cf"]
+        replicas = cls.replicas(level, cf)
+        if not replicas or window_end is None:
+            return cls.create(level, cf)
+        allowed = time.time() - window_end - float(config_option("replica_lag_margin", 5))
+        best = None
+        for host in replicas:
+            connection = cls.create(level, cf, host)
+            lag = connection.lag()
+            if lag is not None and lag <= allowed and (best is None or lag < best[0]):
+                best = (lag, connection)
+        connection = cls.create(level, cf) if best is None else best[1]
+        host = connection.pool.name
+        if cls.ROUTES.get((id(cf), level)) != host:
+            cls.ROUTES[(id(cf), level)] = host
+            log.warning("mysql route, level: %s, host: %s, lag: %s, allowed: %.0fs", level, host, None if best is None else best[0], allowed)
+        if best is None:
+            Metrics.observe_fallback()
+        return connection
+
+    def lag(self):
+        """从库延迟秒数(Seconds_Behind_Master), 复制中断或查询失败时为None, 每replica_check_interval秒查询一次"""
+        now = time.time()
+        if now - self.lag_checked >= float(config_option("replica_check_interval", 10)):
+            self.lag_checked = now
+            try:
+                row = self.pool.get("show slave status")
+                self.replica_lag = None if row is None or row["Seconds_Behind_Master"] is None else int(row["Seconds_Behind_Master"])
+            except Exception as e:
+                log.warning("mysql replica status error, host: %s, error: %s", self.pool.name, str(e))
+                self.replica_lag = None
+        return self.replica_lag
+
+    @classmethod
+    def close_all(cls):
+        """关闭所有连接池的空闲连接"""
+        with cls.LOCK:
+            connections, cls.POOLS = cls.POOLS.values(), {}
+        for connection in connections:
+            try:
+                connection.pool.close()
+            except Exception as e:
+                log.error("mysql pool close, host: %s error:%s", connection.pool.name, str(e))
+
+    def __init__(self, connection_pool, level=SERVER_LEVEL, cf=None):
+        self.pool = connection_pool
+        self.level = level
+        self.cf = cf
+        self.throttle = Throttle.create(connection_pool)
+        self.replica_lag = None
+        self.lag_checked = 0
 
     def __getattr__(self, name):
-        func = getattr(self.conn, name)
-        return log_level("info")(func)
+        """torndb的query/get/execute...方法, 读操作连接断开时重试; 流式读取用batches/stream"""
+        if name in pool.Pool.STREAMS:
+            raise AttributeError("Connection.{0} is not supported, use Connection.stream()".format(name))
+
+        def call(conn, query, *args, **kwargs):
+            start = time.time()
+            result = log_level("info")(getattr(conn, name))(query, *args, **kwargs)
+            self.observe(conn, query, time.time() - start)
+            return result
+
+        def wrapper(query, *args, **kwargs):
+            if self.throttle is not None:
+                self.throttle.wait()
+            return self.pool.run(lambda conn: call(conn, query, *args, **kwargs), retry=name in pool.Pool.READS)
+        return wrapper
+
+    def observe(self, conn, query, use):
+        """记录SQL耗时, 超过slow_query_seconds时记录到慢查询日志, conn为执行该SQL的连接"""
+        Metrics.observe_query(use, query)
+        if self.throttle is not None:
+            self.throttle.observe(use)
+        if SlowLog.is_slow(use):
+            SlowLog.record(self, conn, query, use)
+
+    def batches(self, query, fetch_size=None):
+        """服务端游标(SSCursor)执行查询, 每次fetchmany取fetch_size行
+        客户端只保留当前批次, 内存占用与结果集大小无关
+        """
+        fetch_size = fetch_size or int(config_option("fetch_size", 1000))
+        conn, cursor = None, None
+        use = None
+        broken = False
+        try:
+            # 取到第一行之前连接断开可以换连接重试, 之后不能重试
+            attempt = 0
+            if self.throttle is not None:
+                self.throttle.wait()
+            while True:
+                conn = self.pool.acquire()
+                try:
+                    conn._ensure_connected()
+                    cursor = MySQLdb.cursors.SSCursor(conn._db)
+                    start = time.time()
+                    conn._execute(cursor, query, (), {})
+                    break
+                except Exception as e:
+                    if attempt >= self.pool.retries or not pool.lost(e):
+                        raise
+                    attempt += 1
+                    log.warning("mysql connection lost, retry %s, error: %s", attempt, str(e))
+                    self.pool.release(conn, broken=True)
+                    conn, cursor = None, None
+            # 流式查询的耗时 = 执行 + 每次fetchmany, 不含调用方处理和throttle暂停的时间
+            use = time.time() - start
+            column_names = [d[0] for d in cursor.description]
+            while True:
+                fetch_start = time.time()
+                rows = cursor.fetchmany(fetch_size)
+                fetch_use = time.time() - fetch_start
+                use += fetch_use
+                if not rows:
+                    break
+                if self.throttle is not None:
+                    # 暂停期间服务端的查询等待客户端读取, 不继续扫描
+                    self.throttle.observe(fetch_use)
+                    self.throttle.wait()
+                yield [torndb.Row(itertools.izip(column_names, row)) for row in rows]
+        except Exception as e:
+            broken = pool.lost(e)
+            raise
+        finally:
+            if use is not None:
+                log.info("sql [%ss]: %s, fetch_size: %s", use, query, fetch_size)
+            if conn is not None:
+                try:
+                    if cursor is not None:
+                        cursor.close()
+                    # 结果读完后连接空闲, 才能在本连接上查询检查行数
+                    if use is not None and not broken:
+                        self.observe(conn, query, use)
+                except Exception as e:
+                    log.error("mysql cursor close error:%s", str(e))
+                    broken = True
+                self.pool.release(conn, broken)
+
+    def stream(self, query, fetch_size=None):
+        """逐行返回batches的结果"""
+        for rows in self.batches(query, fetch_size):
+            for row in rows:
+                yield row
+
+
+class SlowLog(object):
+    """执行时间超过slow_query_seconds(本进程config.ini, 0为不记录)的SQL
+    在另一个连接上EXPLAIN, 和检查行数、所属unit一起以json行写入slow_log(默认工作目录slow_query.log)
+    plan中type为ALL的表记入full_scan, 用于发现新区服缺少log_tm/get_tm/pve_tm等索引
+    """
+    LOCK = threading.Lock()
+    ROWS_SQL = ("select h.ROWS_EXAMINED as rows_examined, h.ROWS_SENT as rows_sent from performance_schema.events_statements_history h "
+                "join performance_schema.threads t on h.THREAD_ID=t.THREAD_ID where t.PROCESSLIST_ID=connection_id() order by h.EVENT_ID desc limit 1")
+
+    @classmethod
+    def is_slow(cls, use):
+        threshold = float(config_option("slow_query_seconds", 0))
+        return threshold > 0 and use >= threshold
+
+    @classmethod
+    def rows(cls, conn):
+        """conn上一条语句的实际检查/返回行数, 需要开启performance_schema, 否则为None"""
+        try:
+            row = conn.get(cls.ROWS_SQL)
+        except Exception:
+            return None, None
+        if row is None:
+            return None, None
+        return row["rows_examined"], row["rows_sent"]
+
+    @classmethod
+    def explain(cls, connection, query):
+        """从连接池另取一个连接, 直接使用torndb连接, EXPLAIN本身不再计时和记录"""
+        if not query.lstrip().lower().startswith("select"):
+            return None
+        return [dict(row) for row in connection.pool.query("explain " + query)]
+
+    @classmethod
+    def record(cls, connection, conn, query, use):
+        """记录失败只写日志, 不影响抽取"""
+        try:
+            rows_examined, rows_sent = cls.rows(conn)
+            current = Metrics.current()
+            item = {
+                "time": Util.timestamp_datetime(time.time()),
+                "host": connection.pool.name,
+                "labels": dict(current[0].labels) if current else {},
+                "unit": current[1] if current else None,
+                "seconds": round(use, 3),
+                "rows_examined": rows_examined,
+                "rows_sent": rows_sent,
+                "sql": query,
+            }
+            try:
+                plan = cls.explain(connection, query)
+                item["plan"] = plan
+                item["full_scan"] = [row.get("table") for row in plan or [] if row.get("type") == "ALL"]
+            except Exception as e:
+                item["explain_error"] = str(e)
+            line = json.dumps(item, default=str, ensure_ascii=False)
+            if isinstance(line, unicode):
+                line = line.encode("utf8")
+            path = config_option("slow_log", os.path.join(env["cwd"], "slow_query.log"))
+            with cls.LOCK:
+                with open(path, "a") as f:
+                    f.write(line + "\n")
+            log.warning("slow query [%ss], unit: %s, full scan: %s", use, item["unit"], item.get("full_scan"))
+        except Exception as e:
+            log.error("slow query record error:%s\n%s", str(e), traceback.format_exc())
+
+
+class Throttle(object):
+    """数据库繁忙时在查询之前和分批读取之间暂停, 避免抽取与游戏高峰叠加(本进程config.ini, throttle = 1 开启)
+    繁忙: Threads_running >= throttle_threads_running 或 SQL/每批读取耗时的EWMA >= throttle_latency 秒
+    繁忙时暂停时间从throttle_min_pause秒开始加倍, 最多throttle_max_pause秒; 空闲后每次减半, 低于throttle_min_pause时不再暂停
+    Threads_running每throttle_status_interval秒查询一次
+    """
+    def __init__(self, connection_pool, threads_running=32, latency=2.0, interval=5, min_pause=0.5, max_pause=30, alpha=0.3):
+        self.pool = connection_pool
+        self.threads_running_limit = threads_running
+        self.latency_limit = latency
+        self.interval = interval
+        self.min_pause = min_pause
+        self.max_pause = max_pause
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.latency = None     # 耗时的EWMA
+        self.threads_running = 0
+        self.checked = 0
+        self.pause = 0.0        # 当前暂停秒数
+        self.busy = False
+
+    @classmethod
+    def create(cls, connection_pool):
+        if config_option("throttle", "0") in ("0", "", "false"):
+            return None
+        return cls(connection_pool, int(config_option("throttle_threads_running", 32)), float(config_option("throttle_latency", 2.0)),
+                   float(config_option("throttle_status_interval", 5)), float(config_option("throttle_min_pause", 0.5)),
+                   float(config_option("throttle_max_pause", 30)))
+
+    def observe(self, use):
+        with self.lock:
+            self.latency = use if self.latency is None else self.alpha * use + (1 - self.alpha) * self.latency
+
+    def status(self):
+        """直接使用连接池查询, 不经过Connection, 不计入耗时"""
+        now = time.time()
+        with self.lock:
+            if now - self.checked < self.interval:
+                return
+            self.checked = now
+        try:
+            row = self.pool.get("show global status like 'Threads_running'")
+            self.threads_running = int(row["Value"])
+        except Exception as e:
+            log.warning("throttle status error, pool: %s, error: %s", self.pool.name, str(e))
+
+    def wait(self):
+        """查询之前和分批读取之间调用"""
+        self.status()
+        with self.lock:
+            busy = self.threads_running >= self.threads_running_limit or (self.latency is not None and self.latency >= self.latency_limit)
+            if busy:
+                self.pause = min(self.max_pause, max(self.pause * 2, self.min_pause))
+            else:
+                self.pause = self.pause / 2 if self.pause / 2 >= self.min_pause else 0.0
+            if busy != self.busy:
+                log.warning("throttle %s, pool: %s, threads_running: %s, latency: %s", "busy" if busy else "idle", self.pool.name, self.threads_running, self.latency)
+            self.busy = busy
+            pause = self.pause
+        if pause:
+            Metrics.observe_throttle(pause)
+            time.sleep(pause)
 
 
 class Util(object):
+    NUMBER_PREFIX = re.compile(r"\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?")
+    EPOCH = datetime.datetime(1970, 1, 1)
+    EPOCH_ORDINAL = EPOCH.toordinal()
+    DAYS = {}       # 按TIME_ZONE的天数 -> "YYYY-MM-DD"
+
+    @classmethod
+    def mysql_nonzero(cls, value):
+        """同MySQL中 value is not null and value != 0, 字符串按开头的数字比较, 没有数字时为0"""
+        if value is None:
+            return False
+        if isinstance(value, basestring):
+            match = cls.NUMBER_PREFIX.match(value)
+            return match is not None and float(match.group()) != 0
+        return value != 0
+
     @classmethod
     def timestamp_datetime(cls, timestamp, strf=True):
+        """按TIME_ZONE换算, 不依赖进程的时区; 日期字符串按天缓存"""
         if strf:
-            return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+            day, seconds = divmod(int(timestamp) + TIME_ZONE[1], 86400)
+            date = cls.DAYS.get(day)
+            if date is None:
+                date = cls.DAYS[day] = str(cls.EPOCH.date() + datetime.timedelta(days=day))
+            return "%s %02d:%02d:%02d" % (date, seconds // 3600, seconds // 60 % 60, seconds % 60)
         else:
-            return datetime.datetime.fromtimestamp(timestamp)
+            return cls.EPOCH + datetime.timedelta(seconds=timestamp + TIME_ZONE[1])
 
     @classmethod
     def datetime_timestamp(cls, date_time):
-        return int(time.mktime(date_time.timetuple()))
+        """TIME_ZONE的日期时间 -> 时间戳, 忽略微秒"""
+        return (date_time.toordinal() - cls.EPOCH_ORDINAL) * 86400 + date_time.hour * 3600 + date_time.minute * 60 + date_time.second - TIME_ZONE[1]
+
+    @classmethod
+    def chunks(cls, iterable, size):
+        """按size个一组取出"""
+        iterator = iter(iterable)
+        while True:
+            chunk = list(itertools.islice(iterator, size))
+            if not chunk:
+                return
+            yield chunk
+
+
+class Block(object):
+    """向量化格式化(vectorize = 1)的一块查询结果, 需要numpy
+    按列取值, 时间戳/日期/时间整列计算, 代替逐行的 Util.datetime_timestamp, .date(), .time()
+    """
+    # numpy.array(datetime列表, "datetime64[s]")逐个解析很慢, 改为对象数组相减后取秒数
+    SECONDS = numpy.frompyfunc(datetime.timedelta.total_seconds, 1, 1) if numpy is not None else None
+
+    def __init__(self, rows, default_snid):
+        self.rows = rows
+        self.size = len(rows)
+        self.default_snid = default_snid
+        self.all = numpy.arange(self.size)
+        self.columns = {}
+
+    def column(self, name, default=None):
+        """numpy对象数组, 查询结果中没有该字段时全部为default"""
+        if name not in self.columns:
+            column = numpy.empty(self.size, dtype=object)
+            column[:] = map(itemgetter(name), self.rows) if name in self.rows[0] else default
+            self.columns[name] = column
+        return self.columns[name]
+
+    def where(self, mask):
+        """满足条件的行号"""
+        return numpy.flatnonzero(mask.astype(bool))
+
+    def snid(self, name="channelid"):
+        """同Unit.get_snid"""
+        channel = self.column(name)
+        snid = channel.copy()
+        snid[channel == 0] = self.default_snid
+        return snid
+
+    def clock(self, name):
+        """返回 (时间戳, 日期, 时间) 三列, 与 Util.datetime_timestamp(t), str(t.date()), str(t.time()) 相同"""
+        seconds = self.SECONDS(self.column(name) - Util.EPOCH).astype(numpy.int64)
+        timestamps = seconds - TIME_ZONE[1]
+        # YYYY-MM-DDTHH:MM:SS
+        text = numpy.datetime_as_string(seconds.astype("datetime64[s]")).astype("S19")
+        dates = text.astype("S10")
+        times = numpy.ascontiguousarray(text.view("S1").reshape(self.size, 19)[:, 11:]).view("S8").reshape(self.size)
+        return timestamps, dates, times
+
+
+class PlayerCache(object):
+    """helix_player维度缓存, 抽取时不再连接helix_player, 在本地补齐lv/vip/channelid
+    playerid -> (uid, lv, vip, channelid, lastoptm)
+    按lastoptm/createtm增量刷新, 每隔full_interval秒全量刷新一次, 保存在本地文件中供下次运行使用
+    """
+    FIELDS = ("uid", "lv", "vip", "channelid", "lastoptm")
+    VERSION = 1
+
+    def __init__(self, path, cf, slack=300, full_interval=86400):
+        self.path = path
+        self.cf = cf
+        self.db_game = cf.get(SERVER_LEVEL, "db_game")
+        self.slack = slack                  # 增量刷新时向前多取的秒数, 避免漏掉刚提交的更新
+        self.full_interval = full_interval
+        self.players = {}
+        self.uids = {}                      # uid -> playerid
+        self.refresh_tm = 0                 # 上次刷新时间
+        self.full_tm = 0                    # 上次全量刷新时间
+        self.previous_tm = 0                # 本次刷新之前的refresh_tm
+
+    @classmethod
+    def create(cls, server):
+        """player_cache开启时返回缓存, 否则返回None"""
+        option = partial(config_option, cf=server["cf"])
+        if option("player_cache", "0") in ("0", "", "false"):
+            return None
+        path = option("player_cache_path", os.path.join(server["cwd"], "player_cache.pkl"))
+        slack = int(option("player_cache_slack", 300))
+        full_interval = int(option("player_cache_full", 86400))
+        cache = cls(path, server["cf"], slack, full_interval)
+        cache.load()
+        return cache
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                version, db_game, refresh_tm, full_tm, players = cPickle.load(f)
+        except Exception as e:
+            log.error("player cache load:%s error:%s", self.path, str(e))
+            return
+        if version != self.VERSION or db_game != self.db_game:
+            log.warning("player cache:%s is outdated, ignore", self.path)
+            return
+        self.refresh_tm, self.full_tm, self.players = refresh_tm, full_tm, players
+        self.uids = dict((player[0], playerid) for playerid, player in players.iteritems())
+        log.info("player cache load:%s, players: %s, refresh_tm: %s", self.path, len(self.players), self.refresh_tm)
+
+    def save(self):
+        """写临时文件后重命名, 中途失败不会破坏原缓存"""
+        tmp = "{0}.{1}.tmp".format(self.path, os.getpid())
+        with open(tmp, "wb") as f:
+            cPickle.dump((self.VERSION, self.db_game, self.refresh_tm, self.full_tm, self.players), f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path)
+
+    def refresh(self, now):
+        """返回本次变化的玩家 playerid -> 刷新前的lastoptm(新玩家为None)"""
+        sql = "select playerid, uid, lv, vip, channelid, lastoptm from {0}.helix_player".format(self.db_game)
+        if now - self.full_tm >= self.full_interval:
+            sqls = [sql]
+            self.players = {}
+            self.uids = {}
+            self.full_tm = now
+        else:
+            since = self.refresh_tm - self.slack
+            sqls = ["{0} where lastoptm>={1}".format(sql, since), "{0} where createtm>={1}".format(sql, since)]
+
+        changed = {}
+        # 与各unit相同, 只使用已复制到now(本次抽取的结束时间)的从库; 缓存中没有的玩家的日志会被enrich跳过, 之后不会再抽取
+        connection = Connection.route(SERVER_LEVEL, self.cf, now)
+        for sql in sqls:
+            for row in connection.stream(sql):
+                playerid = row["playerid"]
+                old = self.players.get(playerid)
+                if playerid not in changed:
+                    changed[playerid] = None if old is None else old[4]
+                self.players[playerid] = (row["uid"], row["lv"], row["vip"], row["channelid"], row["lastoptm"])
+                self.uids[row["uid"]] = playerid
+        self.previous_tm, self.refresh_tm = self.refresh_tm, now
+        log.info("player cache refresh, full: %s, changed: %s, players: %s", len(sqls) == 1, len(changed), len(self.players))
+        self.save()
+        return changed
+
+    def apply(self, row):
+        """binlog中helix_player的新值"""
+        playerid = row["playerid"]
+        old = self.players.get(playerid)
+        if old is not None and old[0] != row["uid"]:
+            self.uids.pop(old[0], None)
+        self.players[playerid] = tuple(row[field] for field in self.FIELDS)
+        self.uids[row["uid"]] = playerid
+
+    def get(self, playerid):
+        player = self.players.get(playerid)
+        if player is None:
+            return None
+        return torndb.Row(itertools.izip(self.FIELDS, player), playerid=playerid)
+
+    def get_by_uid(self, uid):
+        playerid = self.uids.get(uid)
+        if playerid is None:
+            return None
+        return self.get(playerid)
+
+    def lookup(self, key, ids):
+        """key: playerid/uid, 返回 id -> Row(playerid, uid, lv, vip, channelid, lastoptm)"""
+        get = self.get if key == "playerid" else self.get_by_uid
+        players = {}
+        for i in ids:
+            player = get(i)
+            if player is not None:
+                players[i] = player
+        return players
+
+    def enrich(self, rows, fields):
+        """fields: 结果字段 -> 缓存字段, 缓存中没有的玩家跳过(同inner join)"""
+        index = [(name, self.FIELDS.index(field)) for name, field in fields.iteritems()]
+        players = self.players
+        for row in rows:
+            player = players.get(row["playerid"])
+            if player is None:
+                continue
+            for name, i in index:
+                row[name] = player[i]
+            yield row
+
+
+class Serializer(object):
+    """BI_记录模板, 模板只解析一次
+    BI_online|gameid#|clientid#  ->  字段: gameid, clientid
+    """
+    def __init__(self, template, delimiter='#'):
+        self.template = template
+        self.parts = []     # (字段名, 后缀), 字段名为None时原样输出
+        keys = template.split('|')
+        self.record_type = keys[0]
+        for key in keys[1:]:
+            start = key.find(delimiter)
+            if start != -1:
+                self.parts.append((key[:start], key[start + 1:]))
+            else:
+                self.parts.append((None, key))
+        self.fields = [name for name, suffix in self.parts if name is not None]
+
+    def bind(self, static):
+        """static中的字段直接写入格式串, 其余字段按模板顺序成为位置参数"""
+        def escape(text):
+            return text.replace("{", "{{").replace("}", "}}")
+
+        pieces = [escape(self.record_type)]
+        fields = []
+        values = {}
+        for name, suffix in self.parts:
+            if name is None:
+                pieces.append(escape(suffix))
+            elif name in static:
+                value = values[name] = "{0}".format(static[name])
+                pieces.append("{0}{{{{{1}}}}}{2}".format(escape(name), escape(value), escape(suffix)))
+            else:
+                pieces.append("{0}{{{{{{{1}}}}}}}{2}".format(escape(name), len(fields), escape(suffix)))
+                fields.append(name)
+        return BoundSerializer(self.record_type, "|".join(pieces), fields, values)
+
+
+class BoundSerializer(object):
+    """绑定了静态字段的模板, values按fields的顺序传入"""
+    def __init__(self, record_type, fmt, fields, static):
+        self.record_type = record_type
+        self.fmt = fmt
+        self.fields = fields
+        self.static = static    # 已绑定字段 -> 字符串值
+
+    def render(self, values):
+        return self.fmt.format(*values)
+
+    def render_block(self, columns, size):
+        """columns: 每个字段一列, 返回size行记录"""
+        if not columns:
+            return [self.fmt.format()] * size
+        return map(self.fmt.format, *columns)
+
+
+SERIALIZERS = {}
+
+
+def register(template):
+    serializer = Serializer(template)
+    SERIALIZERS[serializer.record_type] = serializer
+    return serializer
+
+
+register("BI_online|gameid#|clientid#|online_timestamp#|users#|online_date#|online_time#\n")
+register("BI_login|IP#|gameid#|snid#|openid#|device#|OS#|MAC#|login_timestamp#|login_date#|login_time#\n")
+register("BI_role_login|IP#|gameid#|clientid#|snid#|type#|openid#|roleid#|level#|online_time#|rolelogin_timestamp#|rolelogin_date#|rolelogin_time#\n")
+register("BI_payment|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|amount#|currency#|val#|transactionid#|payment_timestamp#|payment_date#|payment_time#\n")
+register("BI_role_new|IP#|gameid#|clientid#|snid#|openid#|roleid#|rolename#|school#|role_timestamp#|role_date#|role_time#\n")
+register("BI_consume|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|consume_timestamp#|consume_sum#|own_after#|goodsid#|goodsprice#|goodsnum#|consume_date#|consume_time#\n")
+register("BI_mission|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|mission_timestamp#|event_date#|event_time#|mission_type#|mission_level#|event_name#|event_ID#|event_OK#\n")
+register("BI_gold_get|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|gold_sum#|gold_total#|poundage#|get_wayid#|get_wayclassid#|get_timestamp#|get_date#|get_time#|extend_1#|extend_2#\n")
+register("BI_gold_consume|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|gold_sum#|gold_total#|poundage#|consume_wayid#|consume_wayclassid#|goodsid#|goodsprice#|goodsnum#|consume_timestamp#|consume_date#|consume_time#|extend_1#|extend_2#\n")
+register("BI_other_get|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|other_sum#|other_total#|poundage#|get_wayid#|get_wayclassid#|get_timestamp#|get_date#|get_time#|currency_type#|extend_1#\n")
+register("BI_other_consume|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|other_sum#|other_total#|poundage#|consume_wayid#|consume_wayclassid#|goodsid#|goodsprice#|goodsnum#|consume_timestamp#|consume_date#|consume_time#|currency_type#|extend_1#\n")
+register("BI_props_get|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|get_timestamp#|get_sum#|own_after#|propsid#|get_wayid#|get_wayclassid#|get_date#|get_time#|type#|extend_1#|extend_2#\n")
+register("BI_props_consume|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|consume_timestamp#|consume_sum#|own_after#|propsid#|consume_wayid#|consume_wayclassid#|consume_date#|consume_time#|extend_1#|extend_2#\n")
+
+
+class Columnar(object):
+    """列式输出(output_format = columnar), 需要msgpack
+    文件由批次组成, 每批: 4字节大端长度 + msgpack map
+    {"v": 1, "type": "BI_mission", "rows": 行数, "static": {字段: 字符串}, "fields": [字段], "columns": [[值, ...], ...]}
+    static为同一批中相同的字段, fields/columns为逐行变化的字段, 同一列的值类型相同
+    int/float/bool/None/字符串保持原类型, 其余(date, time, Decimal)按文本格式转成字符串
+    """
+    VERSION = 1
+    NATIVE = (int, long, float, bool, str, unicode, type(None))
+    HEADER = struct.Struct(">I")
+
+    def __init__(self, write, batch_rows=8192):
+        if msgpack is None:
+            raise ImportError("output_format=columnar need python package msgpack")
+        self.write = write
+        self.batch_rows = batch_rows
+        self.batches = {}   # BoundSerializer -> [values, ...]
+
+    @classmethod
+    def value(cls, value):
+        return value if isinstance(value, cls.NATIVE) else "{0}".format(value)
+
+    def append(self, row, values):
+        rows = self.batches.setdefault(row, [])
+        rows.append([self.value(value) for value in values])
+        if len(rows) >= self.batch_rows:
+            self.flush_batch(row)
+
+    def flush_batch(self, row):
+        rows = self.batches.pop(row, None)
+        if not rows:
+            return
+        # 键和字段名用msgpack str类型, 值中的str(bytes)为bin类型
+        batch = {
+            u"v": self.VERSION,
+            u"type": row.record_type.decode("utf8"),
+            u"rows": len(rows),
+            u"static": dict((name.decode("utf8"), value) for name, value in row.static.iteritems()),
+            u"fields": [name.decode("utf8") for name in row.fields],
+            u"columns": [list(column) for column in zip(*rows)],
+        }
+        data = msgpack.packb(batch, use_bin_type=True)
+        self.write(self.HEADER.pack(len(data)) + data)
+
+    def flush(self):
+        for row in self.batches.keys():
+            self.flush_batch(row)
+
+    @classmethod
+    def open(cls, path):
+        """按后缀解压.gz/.zst"""
+        if path.endswith(".gz"):
+            return gzip.open(path, "rb")
+        if path.endswith(".zst"):
+            if zstandard is None:
+                raise ImportError("read .zst need python package zstandard")
+            return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+        return open(path, "rb")
+
+    @classmethod
+    def read(cls, fileobj):
+        """逐批返回批次map"""
+        while True:
+            header = fileobj.read(cls.HEADER.size)
+            if not header:
+                return
+            if len(header) < cls.HEADER.size:
+                raise ValueError("truncated batch header")
+            size, = cls.HEADER.unpack(header)
+            data = fileobj.read(size)
+            if len(data) < size:
+                raise ValueError("truncated batch")
+            batch = msgpack.unpackb(data, raw=False)
+            if batch["v"] != cls.VERSION:
+                raise ValueError("unknown columnar version: %s" % batch["v"])
+            yield batch
+
+    @classmethod
+    def to_text(cls, src, dst):
+        """列式文件转换回 BI_*|字段{值}| 文本格式"""
+        rows = 0
+        with cls.open(src) as fileobj, open(dst, "wb") as out:
+            for batch in cls.read(fileobj):
+                row = SERIALIZERS[batch["type"]].bind(batch["static"])
+                if row.fields != batch["fields"]:
+                    raise ValueError("fields not match template: %s" % batch["type"])
+                # 所有字段都已绑定时(BI_online)没有列
+                for values in zip(*batch["columns"]) if batch["fields"] else [()] * batch["rows"]:
+                    out.write(row.render(values))
+                    rows += 1
+        log.info("columnar to text: %s -> %s, rows: %s", src, dst, rows)
+        return rows
+
+
+class Writer(object):
+    """输出文件, 记录先进入缓冲区, 累计chunk_size字节后一次写入
+    fsync: none 不同步; close 关闭时同步; 数字N 每写入N MB同步一次, 关闭时也同步
+    compress: none/gzip/zstd, 每个chunk压缩成一个完整的gzip member/zstd frame
+    多个member/frame直接拼接仍是合法的压缩文件, 下游不必等文件传完就可以逐帧解压
+    """
+    SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+    def __init__(self, path, chunk_size=1024 * 1024, fsync="none", compress="none", level=None):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.fsync = fsync
+        self.fsync_bytes = int(float(fsync) * 1024 * 1024) if fsync not in ("none", "close") else 0
+        self.compress = compress
+        self.compressor = self.create_compressor(compress, level)
+        self.file = open(path, "wb", 0)     # 不使用文件对象自带的缓冲, 写入失败时可以准确回退
+        self.buffer = []
+        self.buffered = 0
+        self.raw_bytes = 0      # 压缩前的字节数
+        self.bytes = 0          # 已写入文件的字节数
+        self.unsynced = 0
+        self.chunks = 0
+        self.io_time = 0.0      # write/fsync耗时
+        self.start = time.time()
+
+    @classmethod
+    def create_compressor(cls, compress, level=None):
+        """返回 chunk -> 一个完整压缩帧 的函数"""
+        if compress == "none":
+            return None
+        if compress == "gzip":
+            level = 6 if level is None else level
+
+            def gzip_member(chunk):
+                compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                return compressor.compress(chunk) + compressor.flush()
+            return gzip_member
+        if compress == "zstd":
+            if zstandard is None:
+                raise ImportError("compress=zstd need python package zstandard")
+            return zstandard.ZstdCompressor(level=3 if level is None else level, write_content_size=True).compress
+        raise ValueError("unknown compress: %s" % compress)
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        chunk = "".join(self.buffer)
+        self.buffer = []
+        self.raw_bytes += self.buffered
+        self.buffered = 0
+        if self.compressor is not None:
+            chunk = self.compressor(chunk)
+        start = time.time()
+        try:
+            self.file.write(chunk)
+        except Exception:
+            # 去掉写了一半的数据, 文件中只保留完整的chunk
+            self.file.seek(self.bytes)
+            self.file.truncate()
+            raise
+        self.io_time += time.time() - start
+        self.bytes += len(chunk)
+        self.unsynced += len(chunk)
+        self.chunks += 1
+        if self.fsync_bytes and self.unsynced >= self.fsync_bytes:
+            self.sync()
+
+    def sync(self):
+        start = time.time()
+        os.fsync(self.file.fileno())
+        self.io_time += time.time() - start
+        self.unsynced = 0
+
+    def close(self):
+        self.flush()
+        if self.fsync != "none":
+            self.sync()
+        self.file.close()
+        use = time.time() - self.start
+        mb = self.bytes / 1024.0 / 1024
+        log.info("write file:%s, %s bytes(raw %s, %s), %s chunks, fsync: %s, use %.3fs(io %.3fs), %.2f MB/s(io %.2f MB/s)", self.path, self.bytes, self.raw_bytes,
+                 self.compress, self.chunks, self.fsync, use, self.io_time, mb / max(use, 0.001), mb / max(self.io_time, 0.001))
+
+
+class Checkpoint(object):
+    """抽取进度(*_start)保存在本地sqlite文件中, 每次更新是一个fsync的事务
+    进度不存在时从config.ini迁移, 之后不再改写config.ini
+    """
+    STORES = {}
+
+    @classmethod
+    def open(cls, path, cf):
+        """同一个文件在进程内只打开一次"""
+        if path not in cls.STORES:
+            cls.STORES[path] = cls(path, cf)
+        return cls.STORES[path]
+
+    def __init__(self, path, cf):
+        self.path = path
+        self.cf = cf
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("pragma journal_mode=wal")
+        self.db.execute("pragma synchronous=full")
+        self.db.execute("create table if not exists checkpoint(name text primary key, value text not null, updated integer not null)")
+        self.db.execute("create table if not exists seen(kind text not null, key text not null, tm integer not null, primary key(kind, key))")
+        self.values = dict(self.db.execute("select name, value from checkpoint"))
+        log.info("checkpoint open:%s, %s", path, self.values)
+
+    def get(self, name, default=None):
+        with self.lock:
+            if name not in self.values and self.cf.has_option(SERVER_LEVEL, name):
+                value = self.cf.get(SERVER_LEVEL, name)
+                log.warning("checkpoint migrate %s = %s from config.ini", name, value)
+                self._update({name: value})
+            return self.values.get(name, default)
+
+    def set(self, name, value):
+        self.update({name: value})
+
+    def update(self, values, seen=()):
+        """多个进度在同一个事务中更新, seen: 同时提交的SeenSet"""
+        with self.lock:
+            self._update(values, seen)
+
+    def _update(self, values, seen=()):
+        now = int(time.time())
+        self.db.execute("begin immediate")
+        try:
+            for name, value in values.iteritems():
+                self.db.execute("insert or replace into checkpoint(name, value, updated) values(?, ?, ?)", (name, str(value), now))
+            for keys in seen:
+                self.db.executemany("insert or replace into seen(kind, key, tm) values(?, ?, ?)", ((keys.kind, key, tm) for key, tm in keys.added.iteritems()))
+                self.db.execute("delete from seen where kind=? and tm<?", (keys.kind, keys.cutoff))
+        except Exception:
+            self.db.execute("rollback")
+            raise
+        self.db.execute("commit")
+        for name, value in values.iteritems():
+            self.values[name] = str(value)
+        for keys in seen:
+            keys.committed()
+
+    def seen(self, kind):
+        """已提交的 键 -> 时间戳"""
+        with self.lock:
+            return dict(self.db.execute("select key, tm from seen where kind=?", (kind,)))
+
+
+class SeenSet(object):
+    """已输出记录的键(如充值的sdk_orderid), 抽取窗口重叠或重新抽取时跳过已输出的记录
+    保存在checkpoint的seen表中, 与进度在同一个事务中提交; 只保留时间不早于 expire(now) - retention 的键
+    不使用布隆过滤器, 误判会丢掉真实的充值记录
+    """
+    def __init__(self, checkpoint, kind, retention):
+        self.kind = kind
+        self.retention = retention
+        self.keys = checkpoint.seen(kind)
+        self.added = {}         # 未提交的 键 -> 时间戳
+        self.cutoff = 0
+        self.skipped = 0
+
+    def add(self, key, tm):
+        """未输出过时记录下来并返回True"""
+        if key in self.keys:
+            self.skipped += 1
+            return False
+        self.keys[key] = self.added[key] = tm
+        return True
+
+    def expire(self, now):
+        """提交时删除早于now - retention的键"""
+        self.cutoff = now - self.retention
+
+    def committed(self):
+        self.added = {}
+        self.keys = dict((key, tm) for key, tm in self.keys.iteritems() if tm >= self.cutoff)
+
+
+class Window(object):
+    """自适应抽取窗口(adaptive_window = 1), 窗口秒数与进度在同一个事务中保存在checkpoint的 <进度>_window 中
+    每次成功后按本次每秒数据的行数和耗时重新选择: 预计不超过window_target_rows行和window_target_seconds秒
+    新窗口最多为上次的2倍, 在window_min和window_max秒之间, 没有记录时为window_initial秒
+    """
+    def __init__(self, checkpoint, name, initial=3600, min_seconds=60, max_seconds=86400, target_rows=500000, target_seconds=60):
+        self.checkpoint = checkpoint
+        self.name = name
+        self.initial = initial
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.target_rows = target_rows
+        self.target_seconds = target_seconds
+
+    @classmethod
+    def create(cls, unit):
+        """没有进度或没有checkpoint(如bench.py的Sink)的unit不使用窗口"""
+        option = partial(config_option, cf=unit.cf)
+        checkpoint = getattr(unit, "checkpoint", None)
+        if unit.WATERMARK is None or checkpoint is None or option("adaptive_window", "0") in ("0", "", "false"):
+            return None
+        return cls(checkpoint, unit.WATERMARK + "_window", int(option("window_initial", 3600)), int(option("window_min", 60)),
+                   int(option("window_max", 86400)), int(option("window_target_rows", 500000)), float(option("window_target_seconds", 60)))
+
+    def seconds(self):
+        return int(float(self.checkpoint.get(self.name, self.initial)))
+
+    def learn(self, span, rows, use):
+        """span: 本次抽取的秒数, rows/use: 输出的行数和耗时, 返回新的窗口秒数"""
+        seconds = self.seconds()
+        if span <= 0:
+            return seconds
+        sizes = [seconds * 2, self.max_seconds]
+        if rows > 0:
+            sizes.append(self.target_rows * float(span) / rows)
+        if use > 0:
+            sizes.append(self.target_seconds * float(span) / use)
+        return int(max(self.min_seconds, min(sizes)))
+
+
+class Metrics(object):
+    """一次抽取(包括补数据的时间片)的指标, 写成node_exporter textfile(metrics_dir/*.prom)
+    计数器和SQL耗时直方图在本地文件中累计, 进程重启后继续递增; 其余为最近一次抽取的值
+    SQL耗时按执行线程当前的unit归类, 见bind/observe_query
+    """
+    VERSION = 1
+    BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+    LOCAL = threading.local()
+
+    def __init__(self, labels, top=10):
+        self.labels = labels    # 所有指标共有的标签, (名称, 值)
+        self.top = top
+        self.lock = threading.Lock()
+        self.counters = {}      # (指标, 标签) -> 值
+        self.histograms = {}    # 标签 -> [各桶计数..., 总数, 总和]
+        self.gauges = {}
+        self.slow = []          # 最慢的top条SQL, 小顶堆 (耗时, unit, sql)
+
+    @classmethod
+    def bind(cls, metrics, unit):
+        """当前线程之后执行的SQL记在unit名下, unit为None时不再记录"""
+        cls.LOCAL.current = None if metrics is None else (metrics, unit)
+
+    @classmethod
+    def current(cls):
+        """(metrics, unit), 当前线程不在unit中时为None"""
+        return getattr(cls.LOCAL, "current", None)
+
+    @classmethod
+    def observe_query(cls, use, sql):
+        current = cls.current()
+        if current is not None:
+            metrics, unit = current
+            metrics.query(unit, use, sql)
+
+    @classmethod
+    def observe_fallback(cls):
+        """配置了从库但都延迟过大, 使用了主库"""
+        current = cls.current()
+        if current is not None:
+            metrics, unit = current
+            metrics.inc("bi_replica_fallbacks_total", (("unit", unit),))
+
+    @classmethod
+    def observe_throttle(cls, pause):
+        current = cls.current()
+        if current is not None:
+            metrics, unit = current
+            metrics.inc("bi_throttle_pauses_total", (("unit", unit),))
+            metrics.inc("bi_throttle_pause_seconds_total", (("unit", unit),), pause)
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, labels, value):
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def query(self, unit, use, sql):
+        labels = (("unit", unit),)
+        with self.lock:
+            histogram = self.histograms.get(labels)
+            if histogram is None:
+                histogram = self.histograms[labels] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if use <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += use
+            item = (use, unit, " ".join(sql.split())[:300])
+            if len(self.slow) < self.top:
+                heapq.heappush(self.slow, item)
+            elif use > self.slow[0][0]:
+                heapq.heapreplace(self.slow, item)
+
+    def load(self, path):
+        """累加上次保存的计数器和直方图"""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "rb") as f:
+                version, counters, histograms = cPickle.load(f)
+        except Exception as e:
+            log.error("metrics load:%s error:%s", path, str(e))
+            return
+        if version != self.VERSION:
+            return
+        for key, value in counters.iteritems():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for labels, values in histograms.iteritems():
+            histogram = self.histograms.setdefault(labels, [0] * len(values))
+            self.histograms[labels] = [a + b for a, b in zip(histogram, values)]
+
+    def save(self, path):
+        tmp = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            cPickle.dump((self.VERSION, self.counters, self.histograms), f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+
+    @classmethod
+    def escape(cls, value):
+        if isinstance(value, unicode):
+            value = value.encode("utf8")
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    def format_labels(self, labels):
+        return "{" + ",".join('{0}="{1}"'.format(name, self.escape(value)) for name, value in self.labels + labels) + "}"
+
+    def render(self):
+        lines = []
+        last = None
+        for (name, labels), value in sorted(self.counters.items()) + sorted(self.gauges.items()):
+            if name != last:
+                lines.append("# TYPE {0} {1}".format(name, "counter" if name.endswith("_total") else "gauge"))
+                last = name
+            lines.append("{0}{1} {2}".format(name, self.format_labels(labels), repr(float(value))))
+
+        lines.append("# TYPE bi_query_seconds histogram")
+        for labels, histogram in sorted(self.histograms.items()):
+            for bound, count in zip(self.BUCKETS, histogram):
+                lines.append("bi_query_seconds_bucket{0} {1}".format(self.format_labels(labels + (("le", repr(float(bound))),)), count))
+            lines.append("bi_query_seconds_bucket{0} {1}".format(self.format_labels(labels + (("le", "+Inf"),)), histogram[-2]))
+            lines.append("bi_query_seconds_count{0} {1}".format(self.format_labels(labels), histogram[-2]))
+            lines.append("bi_query_seconds_sum{0} {1}".format(self.format_labels(labels), repr(float(histogram[-1]))))
+
+        # sql不作为标签, 避免每条不同的sql产生新的时间序列; 完整sql见慢查询日志(slow_log)
+        lines.append("# TYPE bi_slow_query_seconds gauge")
+        for rank, (use, unit, sql) in enumerate(sorted(self.slow, reverse=True), 1):
+            labels = (("rank", rank), ("unit", unit))
+            lines.append("bi_slow_query_seconds{0} {1}".format(self.format_labels(labels), repr(float(use))))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """写临时文件后重命名, node_exporter不会读到写了一半的文件"""
+        tmp = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(self.render())
+        os.rename(tmp, path)
 
 
 class Extract(object):
-    def __init__(self, start):
+    UNITS_OPTION = "units"
+
+    def __init__(self, start, catch_up=False, server=None):
+        self.server = server or env     # 区服配置, 默认为本进程的config.ini
+        self.cf = self.server["cf"]
         self.start = start
-        self.datetime = datetime.datetime.fromtimestamp(start)
+        self.datetime = Util.timestamp_datetime(start, strf=False)
+        self.catch_up = catch_up    # 补数据的时间片
         self.file = None
         self.set_up()
 
     def set_up(self):
         self.env = self.get_env()
-        self.dst = env["cf"].get(SERVER_LEVEL, "data_dir")
+        self.dst = self.cf.get(SERVER_LEVEL, "data_dir")
         self.filename = self.get_filename()
 
         log.info("now time:%s", self.start)
-        self.reopen()
+        self.players = self.create_players()
+        self.changed = {}       # 本次刷新玩家缓存时变化的玩家, playerid -> 刷新前的lastoptm
+        self.checkpoint = Checkpoint.open(self.option("checkpoint_path", os.path.join(self.server["cwd"], "checkpoint.db")), self.cf)
+        labels = (("gameid", self.env["gameid"]), ("clientid", self.env["clientid"]), ("extract", self.__class__.__name__))
+        self.metrics = Metrics(labels, int(self.option("metrics_top_queries", 10)))
         self.init_unit()
+        self.select_units()
+        self.file = None        # 有unit执行时才创建输出文件, 见run
+        self.file_bytes = 0
+
+    def option(self, key, default=None):
+        return config_option(key, default, cf=self.cf)
+
+    def create_players(self):
+        return None if self.catch_up else PlayerCache.create(self.server)
+
+    def select_units(self):
+        """units: 逗号分隔的unit名称, 只抽取这些unit, 例如binlog模式之外仍需轮询的 online,payment"""
+        names = self.option(self.UNITS_OPTION)
+        if names:
+            names = set(name.strip() for name in names.split(","))
+            self.units = [unit for unit in self.units if unit.name() in names]
+
+    def export_metrics(self, use):
+        """每次抽取结束后写 metrics_dir/bi_<类名>_<clientid>.prom, 未配置metrics_dir时不输出, 失败不影响抽取
+        累计值保存在工作目录的同名.pkl中
+        """
+        metrics_dir = self.option("metrics_dir")
+        if not metrics_dir:
+            return
+        name = "bi_{0}_{1}".format(self.__class__.__name__.lower(), self.env["clientid"])
+        path = os.path.join(metrics_dir, name + ".prom")
+        try:
+            state = os.path.join(self.server["cwd"], name + ".pkl")
+            self.metrics.load(state)
+            self.metrics.set("bi_extract_duration_seconds", (), use)
+            self.metrics.set("bi_extract_last_run_timestamp_seconds", (), self.start)
+            self.metrics.set("bi_extract_file_bytes", (), self.file_bytes)
+            # 多区服进程(run_servers)中只导出本区服使用的连接池
+            for connection in Connection.created(self.cf):
+                if connection.lag_checked:
+                    self.metrics.set("bi_replica_lag_seconds", (("pool", connection.pool.name),), -1 if connection.replica_lag is None else connection.replica_lag)
+                throttle = connection.throttle
+                if throttle is not None:
+                    labels = (("pool", throttle.pool.name),)
+                    self.metrics.set("bi_throttle_threads_running", labels, throttle.threads_running)
+                    self.metrics.set("bi_throttle_latency_seconds", labels, throttle.latency or 0)
+                    self.metrics.set("bi_throttle_pause_seconds", labels, throttle.pause)
+            self.metrics.save(state)
+            self.metrics.write(path)
+        except Exception as e:
+            log.error("metrics write:%s error:%s\n%s", path, str(e), traceback.format_exc())
+
+    def refresh_players(self):
+        """刷新玩家缓存, 失败时不使用缓存, 各unit仍连接helix_player查询"""
+        if self.players is None:
+            return
+        try:
+            self.changed = self.players.refresh(self.start)
+        except Exception as e:
+            log.error("player cache refresh error:%s\n%s", str(e), traceback.format_exc())
+            self.players = None
 
     def reopen(self):
-        self.close()
         path = os.path.join(self.dst, self.filename)
         log.info("open file:%s", path)
-        self.file = open(path, "w")
+        chunk_size = int(self.option("write_chunk_size", 1024 * 1024))
+        level = self.option("compress_level")
+        self.file = Writer(path, chunk_size, self.option("fsync", "none"), self.option("compress", "none"), None if level is None else int(level))
+        self.file_bytes = 0
 
     def write(self, line):
-        try:
-            self.file.write(line)
-        except Exception as e:
-            log.error("write error:%s\n%s", str(e), traceback.format_exc())
-            self.reopen()
+        self.file.write(line)
+
+    def flush(self):
+        self.file.flush()
 
     def close(self):
+        """写入剩余缓冲并关闭, 失败时抛出异常, 文件不会被重命名为.log"""
         if self.file is not None:
-            try:
-                self.file.close()
-            except Exception as e:
-                log.error("close log file:%s error:%s", self.filename, str(e))
+            self.file.close()
+            self.file_bytes = self.file.bytes
+            self.file = None
 
     def get_env(self):
-        get = partial(env["cf"].get, SERVER_LEVEL)
+        get = partial(self.cf.get, SERVER_LEVEL)
         return {
             "clientid": get("clientid"),
             "gameid": get("gameid"),
@@ -192,14 +1357,22 @@ class Extract(object):
         date = self.datetime.strftime("%Y-%m-%d-%H-%M-%S")
         clientid = int(self.env["clientid"])
         rand = "".join([str(random.randrange(0, 9)) for i in range(6)])
-        return "{date}-{clientid:05d}_{rand}.log.tmp".format(**locals())
+        suffix = Writer.SUFFIXES.get(self.option("compress", "none"), "")
+        ext = "msgpack" if self.option("output_format", "text") == "columnar" else "log"
+        return "{date}-{clientid:05d}_{rand}.{ext}{suffix}.tmp".format(**locals())
 
     def rename_filename(self):
-        new_name = self.filename.rstrip(".tmp")
+        new_name = self.filename[:-len(".tmp")]
         old_path = os.path.join(self.dst, self.filename)
         new_path = os.path.join(self.dst, new_name)
         log.info("file rename to %s", new_path)
         os.rename(old_path, new_path)
+        if self.option("fsync", "none") != "none":
+            fd = os.open(self.dst, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
 
     def init_unit(self):
         self.units = [
@@ -211,23 +1384,172 @@ class Extract(object):
             Consume(self),
         ]
 
-    def run(self):
-        for unit in self.units:
-            log.info("unit [%s] start", unit.__class__)
+    def run_unit(self, unit):
+        """执行unit的抽取, 返回异常信息, 成功时为None"""
+        log.info("unit [%s] start", unit.__class__)
+        start = time.time()
+        Metrics.bind(self.metrics, unit.name())
+        try:
+            unit.set_up()
             try:
-                unit.set_up()
                 unit.extract()
+            finally:
+                unit.close_lookup_pool()
+                # 与文本输出一样, 失败前产生的记录也写入
+                unit.flush_columnar()
+        except Exception as e:
+            return e, traceback.format_exc()
+        finally:
+            Metrics.bind(None, None)
+            unit.use += time.time() - start
+        return None
+
+    def flush_unit(self, error):
+        """unit的数据写入文件, 写入失败时该unit记为失败"""
+        try:
+            self.flush()
+        except Exception as e:
+            error = error or (e, traceback.format_exc())
+        return error
+
+    def finish_unit(self, unit, error):
+        """根据抽取结果调用unit的success/failed"""
+        if error is not None:
+            e, tb = error
+            unit.failed(e)
+            err = "{0}\n{1}".format(str(e), tb)
+            log.error(err)
+            log.info("unit [%s] end failed", unit.__class__)
+        else:
+            unit.success()
+            log.info("unit [%s] end success, rows: %s", unit.__class__, unit.rows)
+        self.unit_metrics(unit, error)
+
+    def unit_metrics(self, unit, error):
+        labels = (("unit", unit.name()),)
+        self.metrics.inc("bi_unit_runs_total", labels + (("status", "failed" if error else "success"),))
+        self.metrics.inc("bi_unit_rows_total", labels, unit.rows)
+        self.metrics.inc("bi_unit_bytes_total", labels, unit.bytes)
+        self.metrics.inc("bi_unit_seconds_total", labels, unit.use)
+        self.metrics.set("bi_unit_last_rows", labels, unit.rows)
+        self.metrics.set("bi_unit_last_seconds", labels, unit.use)
+        if unit.WATERMARK is not None:
+            # 进度落后于本次抽取时间的秒数, 失败或补数据未完成时会增大; 读不出进度时unit已失败, 不导出
+            try:
+                self.metrics.set("bi_unit_watermark_lag_seconds", labels, self.start - unit.watermark())
+            except (TypeError, ValueError):
+                pass
+        if unit.window is not None:
+            self.metrics.set("bi_unit_window_seconds", labels, unit.window.seconds())
+
+    def run_concurrent(self, units, workers):
+        """units并发抽取, 各自写入自己的缓冲区, 结束后按原顺序合并到输出文件"""
+        buffer_size = int(self.option("unit_buffer_size", 4 * 1024 * 1024))
+        for unit in units:
+            unit.buffer = tempfile.SpooledTemporaryFile(max_size=buffer_size, dir=self.dst)
+
+        workers_pool = ThreadPool(min(workers, len(units)))
+        try:
+            errors = workers_pool.map(self.run_unit, units)
+        finally:
+            workers_pool.close()
+            workers_pool.join()
+
+        results = []
+        for unit, error in zip(units, errors):
+            buf, unit.buffer = unit.buffer, None
+            try:
+                buf.seek(0)
+                shutil.copyfileobj(buf, self)
             except Exception as e:
-                unit.failed(e)
-                err = "{0}\n{1}".format(str(e), traceback.format_exc())
-                log.error(err)
-                log.info("unit [%s] end failed", unit.__class__)
-            else:
-                unit.success()
-                log.info("unit [%s] end success", unit.__class__)
+                error = error or (e, traceback.format_exc())
+            finally:
+                buf.close()
+            results.append((unit, self.flush_unit(error)))
+        return results
+
+    def slice_ends(self):
+        """停机后补数据: 从最落后的进度开始每slice_seconds秒切一个时间片, 返回各时间片的结束时间"""
+        slice_seconds = int(self.option("slice_seconds", 0))
+        if slice_seconds <= 0:
+            return []
+        watermarks = [watermark for unit, watermark in self.watermarks([unit for unit in self.units if unit.WATERMARK is not None])]
+        if not watermarks:
+            return []
+        return range(min(watermarks) + slice_seconds, self.start, slice_seconds)
+
+    def watermarks(self, units):
+        """补数据用的各unit进度, 读不出进度(如缺少*_start)的unit不参与补数据, 由本次抽取自行报错"""
+        result = []
+        for unit in units:
+            try:
+                result.append((unit, unit.watermark()))
+            except (TypeError, ValueError) as e:
+                log.warning("catch up skip unit: %s, watermark: %s error: %s", unit.name(), unit.WATERMARK, str(e))
+        return result
+
+    def run_catch_up(self):
+        """每个时间片单独生成文件并提交进度, 中断后从最后完成的时间片继续"""
+        if any(unit.window is not None for unit in self.units):
+            return self.run_window_catch_up()
+        ends = self.slice_ends()
+        if ends:
+            log.info("catch up %s slices, %s ~ %s", len(ends), Util.timestamp_datetime(ends[0]), Util.timestamp_datetime(ends[-1]))
+        for end in ends:
+            extract = self.__class__(end, catch_up=True, server=self.server)
+            extract.players = self.players
+            extract.metrics = self.metrics
+            extract.run()
 
-        self.close()
-        self.rename_filename()
+    def run_window_catch_up(self):
+        """adaptive_window: 代替slice_seconds, 进度落后超过窗口的unit各自按窗口补数据
+        每个时间片结束于其中最大的 进度 + 窗口, 不超过窗口的剩余部分由本次抽取完成; 时间片没有推进任何进度时停止
+        """
+        units = [unit for unit, watermark in self.watermarks([unit for unit in self.units if unit.window is not None])]
+        while True:
+            watermarks = [unit.watermark() for unit in units]
+            ends = [watermark + unit.window.seconds() for watermark, unit in zip(watermarks, units)]
+            ends = [end for end in ends if end < self.start]
+            if not ends:
+                return
+            log.info("catch up slice, end %s", Util.timestamp_datetime(max(ends)))
+            extract = self.__class__(max(ends), catch_up=True, server=self.server)
+            extract.players = self.players
+            extract.metrics = self.metrics
+            extract.run()
+            if [unit.watermark() for unit in units] == watermarks:
+                log.warning("catch up stopped, no unit progressed")
+                return
+
+    def run(self):
+        start = time.time()
+        if not self.catch_up:
+            self.refresh_players()
+            self.run_catch_up()
+            units = self.units
+        else:
+            # 时间片中只处理进度落后于时间片结束时间的unit, 在线人数只在最后统计
+            units = [unit for unit in self.units if unit.pending()]
+
+        workers = int(self.option("workers", 1))
+        results = []
+        if units:
+            self.reopen()
+            if workers > 1:
+                results = self.run_concurrent(units, workers)
+            else:
+                results = [(unit, self.flush_unit(self.run_unit(unit))) for unit in units]
+            self.close()
+            self.rename_filename()
+        else:
+            # 如payment的进度固定落后300秒, slice_seconds <= 300时每次都会切出没有unit落后的时间片
+            log.info("no unit to run, skip file")
+        # 文件重命名之后才更新进度, 中途退出时数据会重新抽取, 不会丢失
+        for unit, error in results:
+            self.finish_unit(unit, error)
+        if not self.catch_up:
+            self.export_metrics(time.time() - start)
+        log.info("run use %ss, workers: %s", time.time() - start, workers)
         log.info("######\n")
 
 
@@ -241,11 +1563,163 @@ class ConsumeExtract(Extract):
         ]
 
 
+class BinlogExtract(Extract):
+    """binlog模式的一个输出文件, 由Binlog创建, 事务边界处换文件并保存binlog位置"""
+    UNITS_OPTION = "binlog_units"
+
+    def __init__(self, start, players, server=None):
+        self.shared_players = players
+        Extract.__init__(self, start, server=server)
+        self.reopen()
+        self.opened = time.time()
+        self.handlers = {}      # (库名, 表名) -> [处理方法]
+        for unit in self.units:
+            unit.binlog_set_up()
+            for table, (level, db_name, method) in unit.BINLOG.iteritems():
+                self.handlers.setdefault((unit.get_db(db_name, level), table), []).append(getattr(unit, method))
+
+    def create_players(self):
+        return self.shared_players
+
+    def init_unit(self):
+        self.units = [
+            Login(self),
+            Payment(self),
+            RoleNew(self),
+            Consume(self),
+            Mission(self),
+            Gold(self),
+        ]
+
+    def dispatch(self, schema, table, rows):
+        for handler in self.handlers.get((schema, table), ()):
+            handler(rows)
+
+    def rows(self):
+        return sum(unit.rows for unit in self.units)
+
+    def commit(self, log_file, log_pos):
+        """文件重命名之后才保存binlog位置, 中途退出时从上次位置重新读取, 不会丢失"""
+        for unit in self.units:
+            unit.flush_columnar()
+        self.close()
+        self.rename_filename()
+        seen = [unit.seen for unit in self.units if unit.seen is not None]
+        for keys in seen:
+            keys.expire(int(time.time()))
+        self.checkpoint.update({"binlog_file": log_file, "binlog_pos": log_pos}, seen)
+        log.info("binlog commit %s:%s, rows: %s", log_file, log_pos, self.rows())
+
+
+class Binlog(object):
+    """python data.py binlog [区服config.ini]
+    读取区服数据库(server级别)的行格式binlog(binlog_format=ROW), 代替按时间窗口轮询log_*表, 输出相同的BI_记录
+    helix_player的变化同步到玩家缓存, 必须开启player_cache; login库不在同一个实例时不处理helix_order
+    在事务边界(XID/COMMIT/心跳)且距上个文件超过binlog_flush_seconds秒时换文件, 位置保存在checkpoint(binlog_file, binlog_pos)
+    第一次运行从当前的show master status开始; online和binlog_units之外的unit仍用 b/c 轮询(配置units)
+    """
+    def __init__(self, server=None):
+        if BinLogStreamReader is None:
+            raise ImportError("binlog mode need python package mysql-replication")
+        self.server = server or env
+        self.cf = self.server["cf"]
+        self.players = PlayerCache.create(self.server)
+        if self.players is None:
+            raise ValueError("binlog mode need player_cache = 1")
+
+    def option(self, key, default=None):
+        return config_option(key, default, cf=self.cf)
+
+    def open(self):
+        extract = BinlogExtract(int(time.time()), self.players, self.server)
+        get = partial(self.cf.get, GAME_LEVEL)
+        if get("host") != self.cf.get(SERVER_LEVEL, "host"):
+            for key in extract.handlers.keys():
+                if key[0] == get("db_login"):
+                    log.warning("binlog: %s.%s is not on the server host, skip", *key)
+                    del extract.handlers[key]
+        return extract
+
+    def connection_settings(self):
+        get = partial(self.cf.get, SERVER_LEVEL)
+        pair = get("host").split(":")
+        return {"host": pair[0], "port": int(pair[1]) if len(pair) == 2 else 3306, "user": get("user"), "passwd": get("password")}
+
+    def position(self, checkpoint):
+        log_file, log_pos = checkpoint.get("binlog_file"), checkpoint.get("binlog_pos")
+        if log_file:
+            return log_file, int(log_pos)
+        status = Connection.create(SERVER_LEVEL, self.cf).get("show master status")
+        log.warning("binlog: no checkpoint, start from master status %s:%s", status["File"], status["Position"])
+        return status["File"], int(status["Position"])
+
+    def stream(self, extract, log_file, log_pos, blocking=True):
+        """extract.handlers中各表的binlog, blocking=False时读到当前末尾结束(bench.py binlog回放)"""
+        return BinLogStreamReader(
+            connection_settings=self.connection_settings(),
+            server_id=int(self.option("binlog_server_id", 10000 + int(extract.env["clientid"]))),
+            log_file=log_file, log_pos=log_pos, resume_stream=True, blocking=blocking,
+            slave_heartbeat=float(self.option("binlog_flush_seconds", 10)),
+            only_events=[WriteRowsEvent, UpdateRowsEvent, QueryEvent, XidEvent, HeartbeatLogEvent],
+            only_schemas=list(set(schema for schema, table in extract.handlers)),
+            only_tables=list(set(table for schema, table in extract.handlers)))
+
+    @classmethod
+    def dispatch(cls, extract, event):
+        """行事件交给unit处理, 返回是否为事务边界(XID/COMMIT/心跳)"""
+        if isinstance(event, WriteRowsEvent):
+            extract.dispatch(event.schema, event.table, [(None, row["values"]) for row in event.rows])
+        elif isinstance(event, UpdateRowsEvent):
+            extract.dispatch(event.schema, event.table, [(row["before_values"], row["after_values"]) for row in event.rows])
+        elif not (isinstance(event, QueryEvent) and event.query.strip().upper() == "BEGIN"):
+            return True
+        return False
+
+    def run(self):
+        self.players.refresh(int(time.time()))
+        extract = self.open()
+        log_file, log_pos = self.position(extract.checkpoint)
+        flush_seconds = float(self.option("binlog_flush_seconds", 10))
+        stream = self.stream(extract, log_file, log_pos)
+        log.info("binlog start %s:%s, tables: %s", log_file, log_pos, sorted(extract.handlers))
+        try:
+            for event in stream:
+                if not self.dispatch(extract, event):
+                    continue
+                if time.time() - extract.opened >= flush_seconds:
+                    # 事务边界, 没有输出时只保存位置, 不生成空文件
+                    if extract.rows():
+                        extract.commit(stream.log_file, stream.log_pos)
+                        extract = self.open()
+                    else:
+                        extract.checkpoint.update({"binlog_file": stream.log_file, "binlog_pos": stream.log_pos})
+                        extract.opened = time.time()
+        finally:
+            stream.close()
+
+
 class Unit(object):
+    WATERMARK = None    # config.ini中记录抽取进度的配置项
+    BINLOG = {}         # binlog模式: 表名 -> (级别, 库名配置项, 处理方法名), 方法参数为[(before, after)], 插入时before为None
+
     def __init__(self, owner):
         self.owner = owner
         self.env = self.owner.env
-        self.cf = env["cf"]
+        self.cf = self.owner.cf
+        self.buffer = None     # 并发抽取时unit自己的输出缓冲区
+        self.rows = 0
+        self.bytes = 0
+        self.use = 0.0
+        self.seen = None       # SeenSet, 按键去重的unit设置
+        self.window = Window.create(self)
+        self.window_cap = None  # 本次抽取的结束时间上限, 0为不限制
+        self.lookup_threads = None
+        self.columnar = None
+        if config_option("output_format", "text", cf=self.cf) == "columnar":
+            self.columnar = Columnar(self.write, int(config_option("columnar_batch_rows", 8192, cf=self.cf)))
+        self.vectorize = config_option("vectorize", "0", cf=self.cf) not in ("0", "", "false")
+        if self.vectorize and numpy is None:
+            raise ImportError("vectorize = 1 need python package numpy")
 
     def set_up(self):
         pass
@@ -256,22 +1730,77 @@ class Unit(object):
     def extract(self):
         pass
 
+    def prepare(self, common):
+        """准备记录模板, extract和binlog模式共用"""
+        pass
+
+    def binlog_set_up(self):
+        self.prepare(dict(self.env))
+
+    @classmethod
+    def inserted(cls, rows):
+        return [after for before, after in rows if before is None]
+
+    def name(self):
+        return self.__class__.__name__.lower()
+
+    def write(self, line):
+        self.bytes += len(line)
+        if self.buffer is not None:
+            self.buffer.write(line)
+        else:
+            self.owner.write(line)
+
     def failed(self, e):
         """extract异常时调用"""
         pass
 
+    def watermark(self):
+        return int(float(self.checkpoint.get(self.WATERMARK)))
+
+    def commit(self, value):
+        """更新抽取进度, 已输出的键和新的窗口同时提交"""
+        values = {self.WATERMARK: value}
+        if self.window is not None:
+            values[self.window.name] = self.window.learn(value - self.watermark(), self.rows, self.use)
+        self.checkpoint.update(values, [self.seen] if self.seen is not None else ())
+
+    def window_end(self):
+        """本次抽取的结束时间"""
+        return self.limit(self.env["start"])
+
+    def limit(self, end):
+        """adaptive_window: 补数据或数据库繁忙(throttle)时, 结束时间不超过 进度 + 窗口, 同一次抽取中只选择一次"""
+        if self.window is None:
+            return end
+        if self.window_cap is None:
+            throttle = Connection.create(SERVER_LEVEL, self.cf).throttle
+            self.window_cap = 0
+            if self.catch_up or (throttle is not None and throttle.busy):
+                self.window_cap = self.watermark() + self.window.seconds()
+                if self.window_cap < end:
+                    log.info("%s window %ss, end %s", self.name(), self.window.seconds(), Util.timestamp_datetime(self.window_cap))
+        return min(end, self.window_cap) if self.window_cap else end
+
+    def pending(self):
+        """进度是否落后于本次抽取的结束时间, 读不出进度时不参与补数据(见Extract.watermarks)"""
+        if self.WATERMARK is None:
+            return False
+        try:
+            return self.watermark() < self.window_end()
+        except (TypeError, ValueError):
+            return False
+
+    def connection(self, level=SERVER_LEVEL):
+        """unit的查询都是只读的, 配置了从库时按本次抽取的结束时间选择从库"""
+        return Connection.route(level, self.cf, self.window_end())
+
     def get_db(self, db_name, level=SERVER_LEVEL):
         return self.config_get(db_name, level)
 
-    def config_set(self, key, value, level=SERVER_LEVEL):
-        self.cf.set(level, key, value)
-
     def config_get(self, key, level=SERVER_LEVEL):
         return self.cf.get(level, key)
 
-    def config_save(self):
-        self.cf.write(open(env["config_path"], "w"))
-
     def get_snid(self, snid):
         return self.config_get("default_snid") if snid == 0 else snid
 
@@ -279,24 +1808,123 @@ class Unit(object):
         """extract成功时调用"""
         pass
 
-    def fill(self, row, delimiter='#'):
+    def player_join(self, common, columns, join):
+        """columns/join: 连接helix_player时增加的查询字段和join子句
+        开启player_cache时不连接helix_player, 由enrich从缓存补齐这些字段
         """
-        BI_online|gameid#|snid{1}
-        BI_online|gameid{{{gameid}}}|snid{1}
+        if self.players is None:
+            common["player_columns"] = columns
+            common["player_join"] = join.format(**common)
+        else:
+            common["player_columns"] = ""
+            common["player_join"] = ""
+
+    def enrich(self, rows, **fields):
+        """fields: 结果字段=缓存字段(uid, lv, vip, channelid)"""
+        if self.players is None:
+            return rows
+        return self.players.enrich(rows, fields)
+
+    def lookup_players(self, key, ids, index=None):
+        """按key(uid/playerid)查helix_player, 返回 index(默认同key) -> Row(uid, playerid, channelid, lv, vip)
+        ids去重后按lookup_chunk分批查询, in列表不会超过max_allowed_packet
+        lookup_workers > 1时各批并发查询, 否则依次查询
         """
-        fields = []
-        for key in row.split('|'):
-            start = key.find(delimiter)
-            if start != -1:
-                key = "{0}{{{{{{{0}}}}}}}{1}".format(key[:start], key[start + 1:])
-            fields.append(key)
+        index = index or key
+        ids = set(ids)
+        if self.players is not None:
+            players = self.players.lookup(key, ids)
+            if index == key:
+                return players
+            return dict((player[index], player) for player in players.itervalues())
+
+        chunk_size = int(self.option("lookup_chunk", 500))
+        workers = int(self.option("lookup_workers", 1))
+        quote = (lambda i: '"%s"' % i) if key == "uid" else str
+        ids = list(ids)
+        chunks = [",".join(quote(i) for i in ids[start:start + chunk_size]) for start in xrange(0, len(ids), chunk_size)]
+        sql = "select uid, playerid, channelid, lv, vip from {0}.helix_player where {1} in ({{0}})".format(self.get_db("db_game"), key)
 
-        return "|".join(fields)
+        players = {}
+        if workers > 1 and len(chunks) > 1:
+            results = self.lookup_pool(workers).map(lambda chunk: self.connection(SERVER_LEVEL).query(sql.format(chunk)), chunks)
+        else:
+            results = (self.connection(SERVER_LEVEL).query(sql.format(chunk)) for chunk in chunks)
+        for rows in results:
+            for player in rows:
+                players[player[index]] = player
+        return players
+
+    def lookup_pool(self, workers):
+        """lookup_players并发查询的线程池, 每个unit一个, extract结束时关闭
+        线程中的SQL与创建线程池的线程一样记在当前unit名下
+        """
+        if self.lookup_threads is None:
+            self.lookup_threads = ThreadPool(workers, Metrics.bind, Metrics.current() or (None, None))
+        return self.lookup_threads
+
+    def close_lookup_pool(self):
+        if self.lookup_threads is not None:
+            self.lookup_threads.close()
+            self.lookup_threads.join()
+            self.lookup_threads = None
+
+    def serializer(self, record_type, static, **extra):
+        """取得绑定了静态字段的记录模板, 每次extract只绑定一次"""
+        if extra:
+            static = dict(static, **extra)
+        return SERIALIZERS[record_type].bind(static)
+
+    def emit(self, row, values):
+        """values为模板中未绑定字段的值, 顺序同row.fields"""
+        self.rows += 1
+        if self.columnar is None:
+            self.write(row.render(values))
+        else:
+            self.columnar.append(row, values)
+
+    def blocks(self, rows):
+        """查询结果按 vectorize_block_rows 行分块"""
+        size = int(config_option("vectorize_block_rows", 8192, cf=self.cf))
+        for chunk in Util.chunks(rows, size):
+            yield Block(chunk, self.config_get("default_snid"))
+
+    def emit_block(self, block, parts):
+        """parts: [(模板, 行号, 列)], 列的顺序同row.fields, 行号中的每一行输出一条记录
+        文本输出时整块一次写入, 记录顺序与逐行emit相同
+        """
+        lines = numpy.empty(block.size, dtype=object)
+        lines[:] = ""
+        for row, index, columns in parts:
+            if not len(index):
+                continue
+            values = [column[index].tolist() for column in columns]
+            self.rows += len(index)
+            if self.columnar is None:
+                lines[index] = row.render_block(values, len(index))
+            else:
+                for value in itertools.izip(*values):
+                    self.columnar.append(row, value)
+        if self.columnar is None:
+            self.write("".join(lines.tolist()))
+
+    def flush_columnar(self):
+        """列式输出时写出未满的批次"""
+        if self.columnar is not None:
+            self.columnar.flush()
 
 
 class Online(Unit):
-    """在线人数"""
+    """在线人数, 最近120秒内有操作(lastoptm)的玩家数
+    online_mode = cache 且开启player_cache时, 由玩家缓存刷新读到的lastoptm计算, 每分钟输出一条, 不再count helix_player
+    """
+    def set_up(self):
+        self.last_minute = None
+
     def extract(self):
+        if self.players is not None and self.option("online_mode", "query") == "cache":
+            return self.extract_minutes()
+
         common = dict(self.env)
         common["db_game"] = self.get_db("db_game")
         common["start"] -= 120
@@ -306,57 +1934,104 @@ class Online(Unit):
         common["online_time"] = str(online_dt.time())
 
         sql = "select count(*) as users from {db_game}.helix_player where lastoptm>={start}".format(**common)
-        common["users"] = Connection.create(SERVER_LEVEL).get(sql)["users"]
+        common["users"] = self.connection(SERVER_LEVEL).get(sql)["users"]
 
-        # row = "BI_online|gameid{{{gameid}}}|clientid{{{clientid}}}|online_timestamp{{{online_timestamp}}}|users{{{users}}}|online_date{{{online_date}}}|online_time{{{online_time}}}\n"
-        row = self.fill("BI_online|gameid#|clientid#|online_timestamp#|users#|online_date#|online_time#\n")
+        row = self.serializer("BI_online", common)
+        self.emit(row, ())
 
-        self.write(row.format(**common))
+    def extract_minutes(self):
+        """上次输出之后到 start-120 的每个整分钟X, 统计在[X, X+120]内有操作的玩家
+        玩家在两次刷新读到的lastoptm相差不超过online_session_gap秒时, 认为中间一直在线
+        最早只补到上次刷新前slack秒(这之后有操作的玩家都在本次的changed中), 且不超过online_backfill秒
+        """
+        end = (self.env["start"] - 120) // 60 * 60
+        last = int(self.checkpoint.get("online_minute", 0))
+        if last:
+            covered = self.players.previous_tm - self.players.slack
+            backfill = int(self.option("online_backfill", 3600))
+            first = max(last + 60, -(-covered // 60) * 60, end - backfill)
+        else:
+            first = end
+        if first > end:
+            return
+        gap = int(self.option("online_session_gap", 300))
+        minutes = (end - first) // 60 + 1
+        counts = [0] * (minutes + 1)
+        for playerid, old in self.changed.iteritems():
+            player = self.players.players.get(playerid)
+            if player is None or player[4] < first:
+                continue
+            new = player[4]
+            since = old if old is not None and 0 <= new - old <= gap else new
+            # 与query模式一致, 最后一分钟统计lastoptm>=X的所有玩家
+            since = min(since, end + 120)
+            low = max(0, -(-(since - 120 - first) // 60))
+            high = min(minutes - 1, (new - first) // 60)
+            if low <= high:
+                counts[low] += 1
+                counts[high + 1] -= 1
+
+        common = dict(self.env)
+        row = self.serializer("BI_online", common)
+        users = 0
+        for i in xrange(minutes):
+            users += counts[i]
+            online_timestamp = first + i * 60
+            online_dt = Util.timestamp_datetime(online_timestamp, strf=False)
+            # online_timestamp, users, online_date, online_time
+            self.emit(row, (online_timestamp, users, str(online_dt.date()), str(online_dt.time())))
+        self.last_minute = end
+
+    def success(self):
+        if self.last_minute is not None:
+            self.checkpoint.set("online_minute", self.last_minute)
 
 
 class Login(Unit):
     """用户登录和角色登录"""
+    WATERMARK = "login_start"
+    BINLOG = {"log_login": (SERVER_LEVEL, "db_log", "binlog_login")}
+
     def extract(self):
         common = dict(self.env)
         common["db_game"] = self.get_db("db_game")
         common["db_log"] = self.get_db("db_log")
-        login_start = self.config_get("login_start")
+        login_start = self.watermark()
         common["login_start"] = Util.timestamp_datetime(float(login_start))
-        common["start_dt"] = Util.timestamp_datetime(common["start"])
+        common["start_dt"] = Util.timestamp_datetime(self.window_end())
 
-        log.info("config.ini, login_start = %s(%s)" % (login_start, common["login_start"]))
-        sql = "select log_login.*, helix_player.lv as level from {db_log}.log_login inner join {db_game}.helix_player on log_login.playerid=helix_player.playerid and login_tm>='{login_start}' and login_tm<'{start_dt}'".format(**common)
-        logins = Connection.create(SERVER_LEVEL).iter(sql)
+        log.info("checkpoint, login_start = %s(%s)" % (login_start, common["login_start"]))
+        self.player_join(common, ", helix_player.lv as level", " inner join {db_game}.helix_player on log_login.playerid=helix_player.playerid")
+        sql = "select log_login.*{player_columns} from {db_log}.log_login{player_join} where login_tm>='{login_start}' and login_tm<'{start_dt}'".format(**common)
+        logins = self.enrich(self.connection(SERVER_LEVEL).stream(sql), level="lv")
 
+        self.prepare(common)
         for login in logins:
-            common["IP"] = login["login_ip"]
-            common["snid"] = self.get_snid(login["channelid"])
-            common["openid"] = login["uid"]
-            common["device"] = ""
-            common["OS"] = ""
-            common["MAC"] = ""
-            common["login_timestamp"] = Util.datetime_timestamp(login["login_tm"])
-            common["login_date"] = str(login["login_tm"].date())
-            common["login_time"] = str(login["login_tm"].time())
-
-            common["type"] = "1"
-            common["roleid"] = login["playerid"]
-            common["level"] = login["level"]
-            common["online_time"] = "0"
-            common["rolelogin_timestamp"] = common["login_timestamp"]
-            common["rolelogin_date"] = common["login_date"]
-            common["rolelogin_time"] = common["login_time"]
-
-            row_login = self.fill("BI_login|IP#|gameid#|snid#|openid#|device#|OS#|MAC#|login_timestamp#|login_date#|login_time#\n")
-            row_role_login = self.fill("BI_role_login|IP#|gameid#|clientid#|snid#|type#|openid#|roleid#|level#|online_time#|rolelogin_timestamp#|rolelogin_date#|rolelogin_time#\n")
-
-            self.write(row_login.format(**common))
-            self.write(row_role_login.format(**common))
+            self.emit_login(login)
+
+    def prepare(self, common):
+        self.row_login = self.serializer("BI_login", common, device="", OS="", MAC="")
+        self.row_role_login = self.serializer("BI_role_login", common, type="1", online_time="0")
+
+    def emit_login(self, login):
+        ip = login["login_ip"]
+        snid = self.get_snid(login["channelid"])
+        login_timestamp = Util.datetime_timestamp(login["login_tm"])
+        login_date = str(login["login_tm"].date())
+        login_time = str(login["login_tm"].time())
+
+        # IP, snid, openid, login_timestamp, login_date, login_time
+        self.emit(self.row_login, (ip, snid, login["uid"], login_timestamp, login_date, login_time))
+        # IP, snid, openid, roleid, level, rolelogin_timestamp, rolelogin_date, rolelogin_time
+        self.emit(self.row_role_login, (ip, snid, login["uid"], login["playerid"], login["level"], login_timestamp, login_date, login_time))
+
+    def binlog_login(self, rows):
+        for login in self.enrich(self.inserted(rows), level="lv"):
+            self.emit_login(login)
 
     def success(self):
-        login_start = self.env["start"]
-        self.config_set("login_start", login_start)
-        self.config_save()
+        login_start = self.window_end()
+        self.commit(login_start)
 
         login_start_dt = Util.timestamp_datetime(float(login_start))
         log.info("Login success, update login_start to %s(%s)" % (login_start, login_start_dt))
@@ -364,8 +2039,20 @@ class Login(Unit):
 
 class Payment(Unit):
     """充值表"""
+    WATERMARK = "payment_start"
+    BINLOG = {"helix_order": (GAME_LEVEL, "db_login", "binlog_order")}
+
     def set_up(self):
-        self.start = self.env["start"] - 300
+        self.start = self.window_end()
+        self.set_up_seen()
+
+    def set_up_seen(self):
+        """payment_overlap: 每次从进度往前多取的秒数, 补上延迟提交的订单, 已输出的sdk_orderid保留payment_seen_seconds秒"""
+        self.overlap = int(self.option("payment_overlap", 0))
+        self.seen = SeenSet(self.checkpoint, "sdk_orderid", max(int(self.option("payment_seen_seconds", 86400)), self.overlap))
+
+    def window_end(self):
+        return self.limit(self.env["start"] - 300)
 
     def extract(self):
         common = dict(self.env)
@@ -373,82 +2060,96 @@ class Payment(Unit):
         common["db_game"] = self.get_db("db_game")
         common["clientid"] = common["clientid"]
         common["currency"] = common["currency"]
-        payment_start = self.config_get("payment_start")
+        payment_start = self.watermark() - self.overlap
         common["payment_start"] = Util.timestamp_datetime(float(payment_start))
         common["start_dt"] = Util.timestamp_datetime(self.start)
-        common["IP"] = ""
 
         sql_order = "select platformid, gsid, channelid, uid, playerid, money, jewel, sdk_orderid, createtm from {db_login}.helix_order where createtm >='{payment_start}' and createtm<'{start_dt}' and gsid={clientid} and order_result=1 and feed_result=1".format(**common)
-        values_order = Connection.create(GAME_LEVEL).query(sql_order)
-        if not values_order:
+        log.info("checkpoint, payment_start = %s(%s)" % (payment_start, common["payment_start"]))
+
+        self.prepare(common)
+        for values_order in self.connection(GAME_LEVEL).batches(sql_order):
+            players = self.lookup_players("playerid", (low["playerid"] for low in values_order))
+            for order in values_order:
+                self.emit_order(order, players.get(order["playerid"]))
+
+    def prepare(self, common):
+        common["IP"] = ""
+        self.row_payment = self.serializer("BI_payment", common)
+
+    def emit_order(self, order, player):
+        createtm = order["createtm"]
+        if order["sdk_orderid"] and not self.seen.add(order["sdk_orderid"], Util.datetime_timestamp(createtm)):
             return
+        level = 0 if player is None else player["lv"]
+        vip_level = 0 if player is None else player["vip"]
+        # snid, openid, roleid, level, vip_level, amount, val, transactionid, payment_timestamp, payment_date, payment_time
+        self.emit(self.row_payment, (self.get_snid(order["channelid"]), order["uid"], order["playerid"], level, vip_level, order["money"], order["jewel"],
+                                     order["sdk_orderid"], Util.datetime_timestamp(createtm), createtm.date(), createtm.time()))
 
-        log.info("config.ini, payment_start = %s(%s)" % (payment_start, common["payment_start"]))
+    def binlog_set_up(self):
+        self.set_up_seen()
+        Unit.binlog_set_up(self)
 
-        playerids = ','.join([str(low["playerid"]) for low in values_order])
-        common["playerids"] = playerids
-        sql_player = "select playerid, lv, vip from {db_game}.helix_player where playerid in ({playerids})".format(**common)
-        values_player = Connection.create(SERVER_LEVEL).query(sql_player)
-        players = {}
-        for player in values_player:
-            players[player["playerid"]] = {"vip": player["vip"], "level": player["lv"]}
-
-        for order in values_order:
-            common["openid"] = order["uid"]
-            common["snid"] = self.get_snid(order["channelid"])
-            common["roleid"] = order["playerid"]
-            common["amount"] = order["money"]
-            common["val"] = order["jewel"]
-            common["transactionid"] = order["sdk_orderid"]
-            common["payment_timestamp"] = Util.datetime_timestamp(order["createtm"])
-            common["payment_date"] = order["createtm"].date()
-            common["payment_time"] = order["createtm"].time()
-
-            player = players.get(order["playerid"])
-            common["level"] = 0 if player is None else player["level"]
-            common["vip_level"] = 0 if player is None else player["vip"]
-            row_payment = self.fill("BI_payment|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|amount#|currency#|val#|transactionid#|payment_timestamp#|payment_date#|payment_time#\n")
-            self.write(row_payment.format(**common))
+    def binlog_order(self, rows):
+        """订单在插入时或之后更新为成功(order_result=1 and feed_result=1)时输出一次"""
+        def paid(order):
+            return order is not None and order["order_result"] == 1 and order["feed_result"] == 1
+
+        clientid = int(self.env["clientid"])
+        for before, order in rows:
+            if order["gsid"] == clientid and paid(order) and not paid(before):
+                self.emit_order(order, self.players.get(order["playerid"]))
 
     def success(self):
         payment_start = self.start
-        self.config_set("payment_start", payment_start)
-        self.config_save()
+        self.seen.expire(payment_start)
+        self.commit(payment_start)
+        self.metrics.inc("bi_payment_duplicates_total", (), self.seen.skipped)
         payment_start_dt = Util.timestamp_datetime(float(payment_start))
-        log.info("payment success, update payment_start to %s(%s)" % (payment_start, payment_start_dt))
+        log.info("payment success, update payment_start to %s(%s), duplicates: %s" % (payment_start, payment_start_dt, self.seen.skipped))
 
 
 class RoleNew(Unit):
     """角色建立"""
+    WATERMARK = "register_start"
+    BINLOG = {"helix_player": (SERVER_LEVEL, "db_game", "binlog_player")}
+
     def extract(self):
         common = dict(self.env)
         common["db_game"] = self.get_db("db_game")
-        common["reg_start"] = self.config_get("register_start")
+        common["reg_start"] = self.watermark()
+        common["reg_end"] = self.window_end()
         reg_start_dt = Util.timestamp_datetime(float(common["reg_start"]))
 
-        log.info("config.ini, register_start = %s(%s)" % (common["reg_start"], reg_start_dt))
-        sql = "select * from {db_game}.helix_player where createtm>='{reg_start}' and createtm<'{start}'".format(**common)
-        role_news = Connection.create(SERVER_LEVEL).iter(sql)
+        log.info("checkpoint, register_start = %s(%s)" % (common["reg_start"], reg_start_dt))
+        sql = "select * from {db_game}.helix_player where createtm>='{reg_start}' and createtm<'{reg_end}'".format(**common)
+        role_news = self.connection(SERVER_LEVEL).stream(sql)
 
+        self.prepare(common)
         for role_new in role_news:
-            common["IP"] = ""
-            common["snid"] = self.get_snid(role_new["channelid"])
-            common["openid"] = role_new["uid"]
-            common["roleid"] = role_new["playerid"]
-            common["rolename"] = role_new["playername"].encode("utf-8").replace("\r", "").replace("\n", "").replace("|", "").replace("{", "").replace("}", "")
-            common["school"] = role_new["myguildid"]
-            common["role_timestamp"] = role_new["createtm"]
-            createtm_dt = Util.timestamp_datetime(float(role_new["createtm"]), strf=False)
-            common["role_date"] = str(createtm_dt.date())
-            common["role_time"] = str(createtm_dt.time())
-
-            row_role_new = self.fill("BI_role_new|IP#|gameid#|clientid#|snid#|openid#|roleid#|rolename#|school#|role_timestamp#|role_date#|role_time#\n")
-            self.write(row_role_new.format(**common))
+            self.emit_role_new(role_new)
+
+    def prepare(self, common):
+        self.row_role_new = self.serializer("BI_role_new", common, IP="")
+
+    def emit_role_new(self, role_new):
+        rolename = role_new["playername"].encode("utf-8").replace("\r", "").replace("\n", "").replace("|", "").replace("{", "").replace("}", "")
+        createtm_dt = Util.timestamp_datetime(float(role_new["createtm"]), strf=False)
+        # snid, openid, roleid, rolename, school, role_timestamp, role_date, role_time
+        self.emit(self.row_role_new, (self.get_snid(role_new["channelid"]), role_new["uid"], role_new["playerid"], rolename, role_new["myguildid"],
+                                      role_new["createtm"], str(createtm_dt.date()), str(createtm_dt.time())))
+
+    def binlog_player(self, rows):
+        """新角色输出BI_role_new, 所有变化更新玩家缓存"""
+        for before, player in rows:
+            self.players.apply(player)
+            if before is None:
+                self.emit_role_new(player)
 
     def success(self):
-        reg_start = self.env["start"]
-        self.config_set("register_start", reg_start)
-        self.config_save()
+        reg_start = self.window_end()
+        self.commit(reg_start)
 
         reg_start_dt = Util.timestamp_datetime(float(reg_start))
         log.info("RoleNew success, update register_start to %s(%s)" % (reg_start, reg_start_dt))
@@ -456,41 +2157,45 @@ class RoleNew(Unit):
 
 class Consume(Unit):
     """消耗"""
+    WATERMARK = "consume_start"
+    BINLOG = {"log_jewel": (SERVER_LEVEL, "db_log", "binlog_jewel")}
+
     def extract(self):
         common = dict(self.env)
         common["db_game"] = self.get_db("db_game")
         common["db_log"] = self.get_db("db_log")
-        consume_start = self.config_get("consume_start")
+        consume_start = self.watermark()
         common["consume_start"] = Util.timestamp_datetime(float(consume_start))
-        common["start_dt"] = Util.timestamp_datetime(common["start"])
+        common["start_dt"] = Util.timestamp_datetime(self.window_end())
 
-        log.info("config.ini, consume_start = %s(%s)" % (consume_start, common["consume_start"]))
-        sql = "select log_jewel.*, helix_player.lv as level, helix_player.vip as vip_level from {db_log}.log_jewel inner join {db_game}.helix_player on log_jewel.playerid=helix_player.playerid and num<0 and log_tm>='{consume_start}' and log_tm<'{start_dt}'".format(**common)
-        consumes = Connection.create(SERVER_LEVEL).iter(sql)
+        log.info("checkpoint, consume_start = %s(%s)" % (consume_start, common["consume_start"]))
+        self.player_join(common, ", helix_player.lv as level, helix_player.vip as vip_level", " inner join {db_game}.helix_player on log_jewel.playerid=helix_player.playerid")
+        sql = "select log_jewel.*{player_columns} from {db_log}.log_jewel{player_join} where num<0 and log_tm>='{consume_start}' and log_tm<'{start_dt}'".format(**common)
+        consumes = self.enrich(self.connection(SERVER_LEVEL).stream(sql), level="lv", vip_level="vip")
 
+        self.prepare(common)
         for consume in consumes:
-            common["IP"] = ""
-            common["snid"] = self.get_snid(consume["channelid"])
-            common["openid"] = consume["uid"]
-            common["roleid"] = consume["playerid"]
-            common["level"] = consume["level"]
-            common["vip_level"] = consume["vip_level"]
-            common["consume_timestamp"] = Util.datetime_timestamp(consume["log_tm"])
-            common["consume_sum"] = abs(consume["num"])
-            common["own_after"] = consume["new_num"]
-            common["goodsid"] = consume["fromid"]
-            common["goodsprice"] = common["consume_sum"]
-            common["goodsnum"] = 1
-            common["consume_date"] = str(consume["log_tm"].date())
-            common["consume_time"] = str(consume["log_tm"].time())
-
-            row_consume = self.fill("BI_consume|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|consume_timestamp#|consume_sum#|own_after#|goodsid#|goodsprice#|goodsnum#|consume_date#|consume_time#\n")
-            self.write(row_consume.format(**common))
+            self.emit_consume(consume)
+
+    def prepare(self, common):
+        self.row_consume = self.serializer("BI_consume", common, IP="", goodsnum=1)
+
+    def emit_consume(self, consume):
+        consume_sum = abs(consume["num"])
+        log_tm = consume["log_tm"]
+        # snid, openid, roleid, level, vip_level, consume_timestamp, consume_sum, own_after, goodsid, goodsprice, consume_date, consume_time
+        self.emit(self.row_consume, (self.get_snid(consume["channelid"]), consume["uid"], consume["playerid"], consume["level"], consume["vip_level"],
+                                     Util.datetime_timestamp(log_tm), consume_sum, consume["new_num"], consume["fromid"], consume_sum,
+                                     str(log_tm.date()), str(log_tm.time())))
+
+    def binlog_jewel(self, rows):
+        consumes = (consume for consume in self.inserted(rows) if consume["num"] < 0)
+        for consume in self.enrich(consumes, level="lv", vip_level="vip"):
+            self.emit_consume(consume)
 
     def success(self):
-        consume_start = self.env["start"]
-        self.config_set("consume_start", consume_start)
-        self.config_save()
+        consume_start = self.window_end()
+        self.commit(consume_start)
 
         consume_start_dt = Util.timestamp_datetime(float(consume_start))
         log.info("Consume success, update login_start to %s(%s)" % (consume_start, consume_start_dt))
@@ -498,376 +2203,340 @@ class Consume(Unit):
 
 class Mission(Unit):
     """关卡表"""
+    WATERMARK = "mission_start"
+    BINLOG = {"log_raidboss": (SERVER_LEVEL, "db_log", "binlog_raidboss"), "log_pve": (SERVER_LEVEL, "db_log", "binlog_pve")}
 
     def extract(self):
         common = dict(self.env)
         common["db_log"] = self.get_db("db_log")
         common["db_game"] = self.get_db("db_game")
         common["clientid"] = common["clientid"]
-        mission_start = self.config_get("mission_start")
+        mission_start = self.watermark()
         common["mission_start"] = Util.timestamp_datetime(float(mission_start))
-        common["start_datetime"] = Util.timestamp_datetime(common["start"])
-        common["IP"] = ""
-        common["event_name"] = ""
-        common["mission_type"] = 1
+        common["start_datetime"] = Util.timestamp_datetime(self.window_end())
 
-        log.info("config.ini, mission_start = %s(%s)" % (mission_start, common["mission_start"]))
+        log.info("checkpoint, mission_start = %s(%s)" % (mission_start, common["mission_start"]))
+        self.prepare(common)
         self.log_raidboss(common)
         self.log_pve(common)
 
-    def log_raidboss(self, common):
-        sql_raidboss = "select uid1 as uid, start_tm, stage_key, start_tm, result from {db_log}.log_raidboss where start_tm >= '{mission_start}' and start_tm < '{start_datetime}' and uid1 is not null and  uid1 != 0 union all select uid2 as uid, start_tm, stage_key, start_tm, result from {db_log}.log_raidboss where start_tm >= '{mission_start}' and start_tm < '{start_datetime}' and uid2 is not null and  uid2 != 0 union all select uid3 as uid, start_tm, stage_key, start_tm, result from {db_log}.log_raidboss where start_tm >= '{mission_start}' and start_tm < '{start_datetime}' and uid3 is not null and  uid3 != 0 union all select uid4 as uid, start_tm, stage_key, start_tm, result from {db_log}.log_raidboss where start_tm >= '{mission_start}' and start_tm < '{start_datetime}' and uid4 is not null and  uid4 != 0".format(**common)
-        values_raidboss = Connection.create(SERVER_LEVEL).query(sql_raidboss)
-        if not values_raidboss:
-            return
-        uids_raidboss = ','.join('"%s"' % low["uid"] for low in values_raidboss)
-        common["uids_raidboss"] = uids_raidboss
-
-        sql_boss_player = "select uid, playerid, channelid, lv, vip from {db_game}.helix_player where  uid in ({uids_raidboss})".format(**common)
-        values_boss_player = Connection.create(SERVER_LEVEL).query(sql_boss_player)
-
-        player_raidboss = {}
-        for player in values_boss_player:
-            player_raidboss[player["uid"]] = {"playerid": player["playerid"], "vip": player["vip"], "lv": player["lv"], "channelid": player["channelid"]}
-
-        for boss in values_raidboss:
-            common["openid"] = boss["uid"]
-            common["mission_timestamp"] = Util.datetime_timestamp(boss["start_tm"])
-            common["event_date"] = boss["start_tm"].date()
-            common["event_time"] = boss["start_tm"].time()
-            common["mission_level"] = "普通"
-            common["event_ID"] = boss["stage_key"]
-            common["event_OK"] = 2 if boss["result"] == 1 else 1
-            common["mission_type"] = 2
+    def prepare(self, common):
+        common["IP"] = ""
+        common["event_name"] = ""
+        self.row_raidboss = self.serializer("BI_mission", common, mission_type=2, mission_level="普通")
+        self.row_pve = self.serializer("BI_mission", common, mission_type=1, event_OK=2)
 
-            player = player_raidboss.get(boss["uid"])
+    RAIDBOSS_SLOTS = ("uid1", "uid2", "uid3", "uid4")
 
-            common["level"] = 0 if player is None else player["lv"]
-            common["vip_level"] = 0 if player is None else player["vip"]
-            common["roleid"] = 0 if player is None else player["playerid"]
-            common["snid"] = 0 if player is None else player["channelid"]
-            common["snid"] = self.get_snid(common["snid"])
+    @classmethod
+    def raidboss_sql(cls, common):
+        """每行只读一次, uid1..uid4由客户端展开成多条记录
+        case when uidN != 0 与原来union all的 uidN is not null and uidN != 0 条件相同, 不满足的位置为null
+        """
+        slots = ", ".join("case when {0} != 0 then {0} end as {0}".format(slot) for slot in cls.RAIDBOSS_SLOTS)
+        any_slot = " or ".join("{0} != 0".format(slot) for slot in cls.RAIDBOSS_SLOTS)
+        return "select {0}, start_tm, stage_key, result from {{db_log}}.log_raidboss where start_tm >= '{{mission_start}}' and start_tm < '{{start_datetime}}' and ({1})".format(slots, any_slot).format(**common)
 
-            row_mission = self.fill("BI_mission|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|mission_timestamp#|event_date#|event_time#|mission_type#|mission_level#|event_name#|event_ID#|event_OK#\n")
-            self.write(row_mission.format(**common))
+    def log_raidboss(self, common):
+        slots = self.RAIDBOSS_SLOTS
+        sql_raidboss = self.raidboss_sql(common)
+        for values_raidboss in self.connection(SERVER_LEVEL).batches(sql_raidboss):
+            player_raidboss = self.lookup_players("uid", (boss[slot] for boss in values_raidboss for slot in slots if boss[slot] is not None))
+            for boss in values_raidboss:
+                self.emit_raidboss(boss, player_raidboss)
+
+    def emit_raidboss(self, boss, players):
+        """boss中uid1..uid4不满足 != 0 的位置为None, players: uid -> 玩家"""
+        extra = (boss["stage_key"], 2 if boss["result"] == 1 else 1)
+        for slot in self.RAIDBOSS_SLOTS:
+            uid = boss[slot]
+            if uid is not None:
+                self.emit_mission(self.row_raidboss, uid, players.get(uid), boss["start_tm"], extra)
 
     def log_pve(self, common):
         sql_pve = "select channelid, uid, playerid, pve_tm, typeid, stageid, pve_tm, mapid from {db_log}.log_pve where pve_tm >='{mission_start}' and pve_tm < '{start_datetime}'".format(**common)
-        values_pve = Connection.create(SERVER_LEVEL).query(sql_pve)
-        if not values_pve:
-            return
-        uids_pve = ','.join([str(low["playerid"]) for low in values_pve])
-        common["uids_pve"] = uids_pve
-        sql_player = "select uid, playerid, channelid, lv, vip from {db_game}.helix_player where playerid in ({uids_pve})".format(**common)
-        values_player = Connection.create(SERVER_LEVEL).query(sql_player)
-        player_pve = {}
-        for player in values_player:
-            player_pve[player["uid"]] = {"vip": player["vip"], "lv": player["lv"], "channelid": player["channelid"], "playerid": player["playerid"]}
-
-        for pve in values_pve:
-            common["openid"] = pve["uid"]
-            common["mission_timestamp"] = Util.datetime_timestamp(pve["pve_tm"])
-            common["event_date"] = pve["pve_tm"].date()
-            common["event_time"] = pve["pve_tm"].time()
-            common["mission_level"] = pve["typeid"]
-            common["event_ID"] = "%s:%s:%s" % (pve["mapid"], pve["typeid"], pve["stageid"])
-            common["event_OK"] = 2
-            common["mission_type"] = 1
-
-            player = player_pve.get(pve["uid"])
-
-            common["level"] = 0 if player is None else player["lv"]
-            common["vip_level"] = 0 if player is None else player["vip"]
-            common["roleid"] = 0 if player is None else player["playerid"]
-            common["snid"] = 0 if player is None else player["channelid"]
-            common["snid"] = self.get_snid(common["snid"])
-
-            row_mission = self.fill("BI_mission|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|mission_timestamp#|event_date#|event_time#|mission_type#|mission_level#|event_name#|event_ID#|event_OK#\n")
-            self.write(row_mission.format(**common))
+        for values_pve in self.connection(SERVER_LEVEL).batches(sql_pve):
+            player_pve = self.lookup_players("playerid", (low["playerid"] for low in values_pve), index="uid")
+            for pve in values_pve:
+                self.emit_pve(pve, player_pve.get(pve["uid"]))
+
+    def emit_pve(self, pve, player):
+        event_id = "%s:%s:%s" % (pve["mapid"], pve["typeid"], pve["stageid"])
+        self.emit_mission(self.row_pve, pve["uid"], player, pve["pve_tm"], (pve["typeid"], event_id))
+
+    def binlog_raidboss(self, rows):
+        for boss in self.inserted(rows):
+            for slot in self.RAIDBOSS_SLOTS:
+                if not Util.mysql_nonzero(boss[slot]):
+                    boss[slot] = None
+            uids = [boss[slot] for slot in self.RAIDBOSS_SLOTS if boss[slot] is not None]
+            self.emit_raidboss(boss, self.players.lookup("uid", uids))
+
+    def binlog_pve(self, rows):
+        for pve in self.inserted(rows):
+            player = self.players.get(pve["playerid"])
+            self.emit_pve(pve, player if player is not None and player["uid"] == pve["uid"] else None)
+
+    def emit_mission(self, row_mission, openid, player, event_tm, extra):
+        """extra为模板末尾未绑定的字段: raidboss(event_ID, event_OK), pve(mission_level, event_ID)"""
+        level = 0 if player is None else player["lv"]
+        vip_level = 0 if player is None else player["vip"]
+        roleid = 0 if player is None else player["playerid"]
+        snid = self.get_snid(0 if player is None else player["channelid"])
+        # snid, openid, roleid, level, vip_level, mission_timestamp, event_date, event_time + extra
+        self.emit(row_mission, (snid, openid, roleid, level, vip_level, Util.datetime_timestamp(event_tm), event_tm.date(), event_tm.time()) + extra)
 
     def success(self):
-        mission_start = self.env["start"]
-        self.config_set("mission_start", mission_start)
-        self.config_save()
+        mission_start = self.window_end()
+        self.commit(mission_start)
         mission_start_datetime = Util.timestamp_datetime(float(mission_start))
         log.info("mission success, update mission_start to %s(%s)" % (mission_start, mission_start_datetime))
 
 
-class Gold(Unit):
-    """金币获得/消耗表"""
+class Record(object):
+    """日志表一行输出的一种BI_记录
+    fields: 模板字段 -> 查询结果字段, clock: 时间戳/日期/时间的模板字段, static: 固定值
+    sign: get只输出num>=0的行, consume只输出num<0的行, None输出全部行
+    """
+    def __init__(self, record_type, fields, clock, sign=None, **static):
+        self.record_type = record_type
+        self.fields = fields
+        self.clock = clock
+        self.sign = sign
+        self.static = static
+
+
+class Source(object):
+    """声明式的日志表抽取, 代替每个表手写的SQL和输出代码
+    columns: 查询字段(表别名a), 表中没有的字段在SQL中用常量补齐, 如 "0 as new_num"
+    time: 时间字段(columns中的名称), window: 时间窗口条件的字段, 默认 a.time
+    players: 从helix_player(别名b)或player_cache补齐的字段, 结果字段 -> helix_player字段
+    records: [Record], 每行输出所有满足sign的记录, static: 所有记录共用的固定值
+    """
+    SNID = "@snid"
+    CLOCK = ("@timestamp", "@date", "@time")
+
+    def __init__(self, table, columns, time, records, where="", window=None, players=None, **static):
+        self.table = table
+        self.columns = columns
+        self.time = time
+        self.records = records
+        self.where = where
+        self.window = window or "a." + time
+        self.players = players or {}
+        self.static = static
+
+    def sql(self, common):
+        """common: db_log, window_start, window_end, player_columns, player_join"""
+        where = [self.where] if self.where else []
+        where += ["{0}>='{1}'".format(self.window, common["window_start"]), "{0}<'{1}'".format(self.window, common["window_end"])]
+        return "select {0}{1} from {2}.{3} as a{4} where {5}".format(", ".join(self.columns), common["player_columns"], common["db_log"], self.table,
+                                                                     common["player_join"], " and ".join(where))
+
+    def player_columns(self):
+        return "".join(", b.{0} as {1}".format(column, name) for name, column in sorted(self.players.items()))
+
+    def keys(self, record, fields):
+        """模板中未绑定字段对应的行字段, snid和时间字段在输出前补到行中"""
+        clock = dict(zip(record.clock, self.CLOCK))
+        return [self.SNID if field == "snid" else clock.get(field) or record.fields[field] for field in fields]
+
+
+def currency_source(table, record, prefix, way_class, **static):
+    """货币类日志表(num为正获得, 为负消耗), 获得/消耗各一种记录
+    prefix: 数量字段前缀(gold_sum/gold_total), way_class: get_wayclassid/consume_wayclassid/goodsid的字段
+    """
+    fields = {"openid": "uid", "roleid": "playerid", "level": "lv", "vip_level": "vip", prefix + "_sum": "num", prefix + "_total": "new_num"}
+    return Source(table, ["a.*"], "log_tm", [
+        Record("BI_%s_get" % record, dict(fields, get_wayid="fromid", get_wayclassid=way_class),
+               ("get_timestamp", "get_date", "get_time"), sign="get"),
+        Record("BI_%s_consume" % record, dict(fields, consume_wayid="fromid", consume_wayclassid=way_class, goodsid=way_class, goodsprice="num"),
+               ("consume_timestamp", "consume_date", "consume_time"), sign="consume", goodsnum=1),
+    ], players={"lv": "lv", "vip": "vip"}, **static)
+
+
+class SourceUnit(Unit):
+    """按SOURCES声明抽取的unit, 每个Source一次查询, 逐行或按块(vectorize)输出"""
+    SOURCES = ()
+
+    def sources(self):
+        return self.SOURCES
+
     def extract(self):
         common = dict(self.env)
         common["db_log"] = self.get_db("db_log")
         common["db_game"] = self.get_db("db_game")
-        common["clientid"] = common["clientid"]
-        gold_start = self.config_get("gold_start")
-        common["gold_start"] = Util.timestamp_datetime(float(gold_start))
-        common["start_datetime"] = Util.timestamp_datetime(common["start"])
-        common["IP"] = ""
-        common["poundage"] = 0
-        common["extend_1"] = ""
-        common["extend_2"] = ""
-
-        sql_gold="select log_gold.*, helix_player.lv, helix_player.vip, log_tm from {db_log}.log_gold inner join {db_game}.helix_player on log_gold.playerid=helix_player.playerid and log_tm>='{gold_start}' and log_tm<'{start_datetime}'".format(**common)
-        values_gold = Connection.create(SERVER_LEVEL).iter(sql_gold)
-        for gold in values_gold:
-            self.glod_get(common, gold)
-            self.glod_consume(common, gold)
-
-    def glod_get(self, common, gold):
-        if gold["num"] >=0:
-            common["openid"] = gold["uid"]
-            common["get_timestamp"] = Util.datetime_timestamp(gold["log_tm"])
-            common["get_date"] = gold["log_tm"].date()
-            common["get_time"] = gold["log_tm"].time()
-            common["level"] = gold["lv"]
-            common["vip_level"] = gold["vip"]
-            common["roleid"] = gold["playerid"]
-            common["snid"] = self.get_snid(gold["channelid"])
-            common["get_wayid"] = gold["fromid"]
-            common["get_wayclassid"] = gold["fromid"]
-            common["gold_sum"] = gold["num"]
-            common["gold_total"] = gold["new_num"]
-
-            row_goldget = self.fill("BI_gold_get|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|gold_sum#|gold_total#|poundage#|get_wayid#|get_wayclassid#|get_timestamp#|get_date#|get_time#|extend_1#|extend_2#\n")
-            self.write(row_goldget.format(**common))
-
-    def glod_consume(self, common, gold):
-        if gold["num"] < 0:
-            common["openid"] = gold["uid"]
-            common["consume_timestamp"] = Util.datetime_timestamp(gold["log_tm"])
-            common["consume_date"] = gold["log_tm"].date()
-            common["consume_time"] = gold["log_tm"].time()
-            common["level"] = gold["lv"]
-            common["vip_level"] = gold["vip"]
-            common["roleid"] = gold["playerid"]
-            common["snid"] = self.get_snid(gold["channelid"])
-            common["consume_wayid"] = gold["fromid"]
-            common["consume_wayclassid"] = gold["fromid"]
-            common["gold_sum"] = gold["num"]
-            common["gold_total"] = gold["new_num"]
-            common["goodsid"] = gold["fromid"]
-            common["goodsprice"] = gold["num"]
-            common["goodsnum"] = 1
-
-            row_goldconsume = self.fill("BI_gold_consume|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|gold_sum#|gold_total#|poundage#|consume_wayid#|consume_wayclassid#|goodsid#|goodsprice#|goodsnum#|consume_timestamp#|consume_date#|consume_time#|extend_1#|extend_2#\n")
-            self.write(row_goldconsume.format(**common))
+        start = self.watermark()
+        common["window_start"] = Util.timestamp_datetime(float(start))
+        common["window_end"] = Util.timestamp_datetime(self.window_end())
+
+        log.info("checkpoint, %s = %s(%s)" % (self.WATERMARK, start, common["window_start"]))
+        self.prepare(common)
+        for source in self.sources():
+            log.info("%s, %s" % (self.name(), source.table))
+            self.player_join(common, source.player_columns(), " inner join {db_game}.helix_player as b on a.playerid=b.playerid")
+            rows = self.enrich(self.connection(SERVER_LEVEL).stream(source.sql(common)), **source.players)
+            if self.vectorize:
+                for block in self.blocks(rows):
+                    self.emit_source_block(source, block)
+            else:
+                self.emit_source(source, rows)
+
+    def prepare(self, common):
+        """每个表的 [(记录, 模板, 取值函数)]"""
+        self.bound = {}
+        for source in self.sources():
+            bound = self.bound[source.table] = []
+            for record in source.records:
+                row = self.serializer(record.record_type, common, **dict(source.static, **record.static))
+                bound.append((record, row, itemgetter(*source.keys(record, row.fields))))
+
+    def emit_source(self, source, rows):
+        clock = [record.clock for record in source.records if record.clock]
+        bound = self.bound[source.table]
+        for row in rows:
+            row[Source.SNID] = self.get_snid(row["channelid"])
+            if clock:
+                tm = row[source.time]
+                row["@timestamp"], row["@date"], row["@time"] = Util.datetime_timestamp(tm), str(tm.date()), str(tm.time())
+            for record, serializer, values in bound:
+                if record.sign == "get" and row["num"] < 0 or record.sign == "consume" and row["num"] >= 0:
+                    continue
+                self.emit(serializer, values(row))
+
+    def emit_source_block(self, source, block):
+        """同emit_source, 按块输出"""
+        columns = {Source.SNID: block.snid()}
+        if any(record.clock for record in source.records):
+            columns.update(zip(Source.CLOCK, block.clock(source.time)))
+        parts = []
+        for record, serializer, values in self.bound[source.table]:
+            if record.sign is None:
+                index = block.all
+            else:
+                index = block.where(block.column("num") >= 0 if record.sign == "get" else block.column("num") < 0)
+            keys = source.keys(record, serializer.fields)
+            parts.append((serializer, index, [columns[key] if key in columns else block.column(key) for key in keys]))
+        self.emit_block(block, parts)
+
+    def binlog_source(self, source, rows):
+        self.emit_source(source, self.enrich(self.inserted(rows), **source.players))
 
     def success(self):
-        gold_start = self.env["start"]
-        self.config_set("gold_start", gold_start)
-        self.config_save()
-        gold_start_datetime = Util.timestamp_datetime(float(gold_start))
-        log.info("gold success, update gold_start to %s(%s)" % (gold_start, gold_start_datetime))
+        start = self.window_end()
+        self.commit(start)
+        log.info("%s success, update %s to %s(%s)" % (self.name(), self.WATERMARK, start, Util.timestamp_datetime(float(start))))
 
 
-class Other(Unit):
-    """其他货币获得/消耗表"""
-    def extract(self):
-        common = dict(self.env)
-        common["db_log"] = self.get_db("db_log")
-        common["db_game"] = self.get_db("db_game")
-        common["clientid"] = common["clientid"]
-        other_start = self.config_get("other_start")
-        common["other_start"] = Util.timestamp_datetime(float(other_start))
-        common["start_datetime"] = Util.timestamp_datetime(common["start"])
-        common["IP"] = ""
-        common["poundage"] = 0
-        common["extend_1"] = ""
-
-        self.other_badge(common)
-        self.other_guild(common)
-
-    def other_badge(self, common):
-        """pvp徽章 消耗与 获得"""
-        sql_badge="select log_badge.*, helix_player.lv, helix_player.vip from {db_log}.log_badge inner join {db_game}.helix_player on log_badge.playerid=helix_player.playerid and log_tm>='{other_start}' and log_tm<'{start_datetime}'".format(**common)
-        values_badge = Connection.create(SERVER_LEVEL).iter(sql_badge)
-        for badge in values_badge:
-            if badge["num"] >= 0:
-                common["openid"] = badge["uid"]
-                common["get_timestamp"] = Util.datetime_timestamp(badge["log_tm"])
-                common["get_date"] = badge["log_tm"].date()
-                common["get_time"] = badge["log_tm"].time()
-                common["level"] = badge["lv"]
-                common["vip_level"] = badge["vip"]
-                common["roleid"] = badge["playerid"]
-                common["snid"] = self.get_snid(badge["channelid"])
-                common["get_wayid"] = badge["fromid"]
-                common["get_wayclassid"] = badge["fromid"]
-                common["other_sum"] = badge["num"]
-                common["other_total"] = badge["new_num"]
-                common["currency_type"] = "pvp徽章"
-
-                row_badge_get = self.fill("BI_other_get|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|other_sum#|other_total#|poundage#|get_wayid#|get_wayclassid#|get_timestamp#|get_date#|get_time#|currency_type#|extend_1#\n")
-                self.write(row_badge_get.format(**common))
-
-            elif badge["num"] < 0:
-                common["openid"] = badge["uid"]
-                common["consume_timestamp"] = Util.datetime_timestamp(badge["log_tm"])
-                common["consume_date"] = badge["log_tm"].date()
-                common["consume_time"] = badge["log_tm"].time()
-                common["level"] = badge["lv"]
-                common["vip_level"] = badge["vip"]
-                common["roleid"] = badge["playerid"]
-                common["snid"] = self.get_snid(badge["channelid"])
-                common["consume_wayid"] = badge["fromid"]
-                common["consume_wayclassid"] = badge["fromid"]
-                common["other_sum"] = badge["num"]
-                common["other_total"] = badge["new_num"]
-                common["currency_type"] = "pvp徽章"
-                common["goodsid"] = badge["fromid"]
-                common["goodsprice"] = badge["num"]
-                common["goodsnum"] = 1
-
-                row_badge_consume = self.fill("BI_other_consume|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|other_sum#|other_total#|poundage#|consume_wayid#|consume_wayclassid#|goodsid#|goodsprice#|goodsnum#|consume_timestamp#|consume_date#|consume_time#|currency_type#|extend_1#\n")
-                self.write(row_badge_consume.format(**common))
-
-    def other_guild(self, common):
-        """公会币 消耗与 获得"""
-        sql_badge="select log_guild_coin.*, helix_player.lv, helix_player.vip from {db_log}.log_guild_coin inner join {db_game}.helix_player on log_guild_coin.playerid=helix_player.playerid and log_tm>='{other_start}' and log_tm<'{start_datetime}'".format(**common)
-        values_badge = Connection.create(SERVER_LEVEL).iter(sql_badge)
-        for badge in values_badge:
-            if badge["num"] >=0:
-                common["openid"] = badge["uid"]
-                common["get_timestamp"] = Util.datetime_timestamp(badge["log_tm"])
-                common["get_date"] = badge["log_tm"].date()
-                common["get_time"] = badge["log_tm"].time()
-                common["level"] = badge["lv"]
-                common["vip_level"] = badge["vip"]
-                common["roleid"] = badge["playerid"]
-                common["snid"] = self.get_snid(badge["channelid"])
-                common["get_wayid"] = badge["fromid"]
-                common["get_wayclassid"] = badge["guildid"]
-                common["other_sum"] = badge["num"]
-                common["other_total"] = badge["new_num"]
-                common["currency_type"] = "公会币"
-
-                row_guild_get = self.fill("BI_other_get|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|other_sum#|other_total#|poundage#|get_wayid#|get_wayclassid#|get_timestamp#|get_date#|get_time#|currency_type#|extend_1#\n")
-                self.write(row_guild_get.format(**common))
-
-            elif badge["num"] < 0:
-                common["openid"] = badge["uid"]
-                common["consume_timestamp"] = Util.datetime_timestamp(badge["log_tm"])
-                common["consume_date"] = badge["log_tm"].date()
-                common["consume_time"] = badge["log_tm"].time()
-                common["level"] = badge["lv"]
-                common["vip_level"] = badge["vip"]
-                common["roleid"] = badge["playerid"]
-                common["snid"] = self.get_snid(badge["channelid"])
-                common["consume_wayid"] = badge["fromid"]
-                common["consume_wayclassid"] = badge["guildid"]
-                common["other_sum"] = badge["num"]
-                common["other_total"] = badge["new_num"]
-                common["currency_type"] = "公会币"
-                common["goodsid"] = badge["guildid"]
-                common["goodsprice"] = badge["num"]
-                common["goodsnum"] = 1
-
-                row_guild_consume = self.fill("BI_other_consume|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|other_sum#|other_total#|poundage#|consume_wayid#|consume_wayclassid#|goodsid#|goodsprice#|goodsnum#|consume_timestamp#|consume_date#|consume_time#|currency_type#|extend_1#\n")
-                self.write(row_guild_consume.format(**common))
+class Gold(SourceUnit):
+    """金币获得/消耗表"""
+    WATERMARK = "gold_start"
+    BINLOG = {"log_gold": (SERVER_LEVEL, "db_log", "binlog_gold")}
+    SOURCES = (currency_source("log_gold", "gold", "gold", "fromid", IP="", poundage=0, extend_1="", extend_2=""),)
 
-    def success(self):
-        other_start = self.env["start"]
-        self.config_set("other_start", other_start)
-        self.config_save()
-        other_start_datetime = Util.timestamp_datetime(float(other_start))
-        log.info("other success, update other_start to %s(%s)" % (other_start, other_start_datetime))
+    def binlog_gold(self, rows):
+        self.binlog_source(self.SOURCES[0], rows)
 
 
-class Props(Unit):
-    """道具获得与消耗"""
-    def extract(self):
-        common = dict(self.env)
-        common["db_game"] = self.get_db("db_game")
-        common["db_log"] = self.get_db("db_log")
-        props_start = self.config_get("props_start")
-        common["props_start"] = Util.timestamp_datetime(float(props_start))
-        common["start_dt"] = Util.timestamp_datetime(common["start"])
-
-        log.info("config.ini, props_start = %s(%s)" % (props_start, common["props_start"]))
-        self.props_get(common)
-        self.props_consume(common)
-
-    def props_get(self, common):
-        sqls = {
-            "card": "select a.playerid, a.uid, a.channelid, a.card_key as propsid, a.num, a.fromid as get_wayid, a.get_tm, b.lv as level, b.vip as vip_level from {db_log}.log_get_card as a inner join {db_game}.helix_player as b on a.playerid=b.playerid and a.num>0 and get_tm>='{props_start}' and get_tm<'{start_dt}'".format(**common),
-            "equip": "select a.playerid, a.uid, a.channelid, a.equip_key as propsid, a.num, a.fromid as get_wayid, a.get_tm, b.lv as level, b.vip as vip_level from {db_log}.log_get_equip as a inner join {db_game}.helix_player as b on a.playerid=b.playerid and a.num>0 and get_tm>='{props_start}' and get_tm<'{start_dt}'".format(**common),
-            "medal": "select a.playerid, a.uid, a.channelid, a.medal_key as propsid, a.fromid, a.from_mapid as get_wayid, a.from_stageid, a.num, a.new_num, a.log_tm as get_tm, b.lv as level, b.vip as vip_level from {db_log}.log_get_medal as a inner join {db_game}.helix_player as b on a.playerid=b.playerid and a.num>0 and log_tm>='{props_start}' and log_tm<'{start_dt}'".format(**common),
-        }
-        for k, sql in sqls.iteritems():
-            log.info("props_get, %s" % k)
-            props_gets = Connection.create(SERVER_LEVEL).iter(sql)
-            for props_get in props_gets:
-                common["IP"] = ""
-                common["snid"] = self.get_snid(props_get["channelid"])
-                common["openid"] = props_get["uid"]
-                common["roleid"] = props_get["playerid"]
-                common["level"] = props_get["level"]
-                common["vip_level"] = props_get["vip_level"]
-                common["get_timestamp"] = Util.datetime_timestamp(props_get["get_tm"])
-                common["get_sum"] = props_get["num"]
-                common["own_after"] = props_get.get("new_num", 0)
-                common["propsid"] = "_".join([k, props_get["propsid"]])
-                common["get_wayid"] = props_get["get_wayid"]
-                common["get_wayclassid"] = props_get.get("from_stageid", 0)
-                common["get_date"] = str(props_get["get_tm"].date())
-                common["get_time"] = str(props_get["get_tm"].time())
-                common["type"] = props_get.get("fromid", "unbind")
-                common["extend_1"] = ""
-                common["extend_2"] = ""
-                row_props_get = self.fill("BI_props_get|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|get_timestamp#|get_sum#|own_after#|propsid#|get_wayid#|get_wayclassid#|get_date#|get_time#|type#|extend_1#|extend_2#\n")
-                self.write(row_props_get.format(**common))
-
-    def props_consume(self, common):
-        sqls = {
-            "equip": "select a.playerid, a.uid, a.channelid, a.equip_key as propsid, a.fromid as consume_wayid, a.log_tm, b.lv as level, b.vip as vip_level from {db_log}.log_use_equip as a inner join {db_game}.helix_player as b on a.playerid=b.playerid and log_tm>='{props_start}' and log_tm<'{start_dt}'".format(**common),
-            "medal": "select a.playerid, a.uid, a.channelid, a.medal_key as propsid, a.cardid as consume_wayid, a.num, a.new_num, a.log_tm, b.lv as level, b.vip as vip_level from {db_log}.log_use_medal as a inner join {db_game}.helix_player as b on a.playerid=b.playerid and log_tm>='{props_start}' and log_tm<'{start_dt}'".format(**common),
-        }
-        for k, sql in sqls.iteritems():
-            log.info("props_consume, %s" % k)
-            props_consumes = Connection.create(SERVER_LEVEL).iter(sql)
-            for props_consume in props_consumes:
-                common["IP"] = ""
-                common["snid"] = self.get_snid(props_consume["channelid"])
-                common["openid"] = props_consume["uid"]
-                common["roleid"] = props_consume["playerid"]
-                common["level"] = props_consume["level"]
-                common["vip_level"] = props_consume["vip_level"]
-                common["consume_timestamp"] = Util.datetime_timestamp(props_consume["log_tm"])
-                common["consume_sum"] = props_consume.get("num", 0)
-                common["own_after"] = props_consume.get("new_num", 0)
-                common["propsid"] = "_".join([k, props_consume["propsid"]])
-                common["consume_wayid"] = props_consume["consume_wayid"]
-                common["consume_wayclassid"] = -1
-                common["consume_date"] = str(props_consume["log_tm"].date())
-                common["consume_time"] = str(props_consume["log_tm"].time())
-                common["extend_1"] = ""
-                common["extend_2"] = ""
-                row_props_consume = self.fill("BI_props_consume|IP#|gameid#|clientid#|snid#|openid#|roleid#|level#|vip_level#|consume_timestamp#|consume_sum#|own_after#|propsid#|consume_wayid#|consume_wayclassid#|consume_date#|consume_time#|extend_1#|extend_2#\n")
-                self.write(row_props_consume.format(**common))
+class Other(SourceUnit):
+    """其他货币获得/消耗表
+    other_currencies: 增加的货币, 表名:currency_type,... 表结构同log_badge, 如 log_honor:荣誉
+    """
+    WATERMARK = "other_start"
+    SOURCES = (
+        currency_source("log_badge", "other", "other", "fromid", IP="", poundage=0, extend_1="", currency_type="pvp徽章"),
+        currency_source("log_guild_coin", "other", "other", "guildid", IP="", poundage=0, extend_1="", currency_type="公会币"),
+    )
 
-    def success(self):
-        props_start = self.env["start"]
-        self.config_set("props_start", props_start)
-        self.config_save()
+    def sources(self):
+        sources = list(self.SOURCES)
+        for currency in filter(None, [s.strip() for s in self.option("other_currencies", "").split(",")]):
+            table, currency_type = currency.split(":", 1)
+            sources.append(currency_source(table, "other", "other", "fromid", IP="", poundage=0, extend_1="", currency_type=currency_type))
+        return sources
+
+
+def props_get_source(name, columns, time="get_tm", window=None):
+    return Source("log_get_" + name, ["a.playerid", "a.uid", "a.channelid", "concat('%s_', a.%s_key) as propsid" % (name, name)] + columns, time, [
+        Record("BI_props_get", {"openid": "uid", "roleid": "playerid", "level": "level", "vip_level": "vip_level", "get_sum": "num", "own_after": "new_num",
+                                "propsid": "propsid", "get_wayid": "get_wayid", "get_wayclassid": "from_stageid", "type": "fromid"},
+               ("get_timestamp", "get_date", "get_time")),
+    ], where="a.num>0", window=window, players={"level": "lv", "vip_level": "vip"}, IP="", extend_1="", extend_2="")
+
+
+def props_consume_source(name, columns):
+    return Source("log_use_" + name, ["a.playerid", "a.uid", "a.channelid", "concat('%s_', a.%s_key) as propsid" % (name, name)] + columns, "log_tm", [
+        Record("BI_props_consume", {"openid": "uid", "roleid": "playerid", "level": "level", "vip_level": "vip_level", "consume_sum": "num",
+                                    "own_after": "new_num", "propsid": "propsid", "consume_wayid": "consume_wayid"},
+               ("consume_timestamp", "consume_date", "consume_time")),
+    ], players={"level": "lv", "vip_level": "vip"}, IP="", consume_wayclassid=-1, extend_1="", extend_2="")
+
+
+class Props(SourceUnit):
+    """道具获得与消耗"""
+    WATERMARK = "props_start"
+    SOURCES = (
+        props_get_source("equip", ["a.num", "a.fromid as get_wayid", "a.get_tm", "0 as new_num", "0 as from_stageid", "'unbind' as fromid"]),
+        props_get_source("medal", ["a.fromid", "a.from_mapid as get_wayid", "a.from_stageid", "a.num", "a.new_num", "a.log_tm as get_tm"], window="a.log_tm"),
+        props_get_source("card", ["a.num", "a.fromid as get_wayid", "a.get_tm", "0 as new_num", "0 as from_stageid", "'unbind' as fromid"]),
+        props_consume_source("equip", ["a.fromid as consume_wayid", "a.log_tm", "0 as num", "0 as new_num"]),
+        props_consume_source("medal", ["a.cardid as consume_wayid", "a.num", "a.new_num", "a.log_tm"]),
+    )
+
+
+def run_servers(extract_cls, config_paths, now):
+    """一个进程抽取多个区服, 最多server_workers个区服同时执行
+    进程内相同数据库地址的区服共用连接池(Connection.POOLS), 单个区服失败不影响其他区服
+    """
+    def run_server(config_path):
+        start = time.time()
+        log.info("server [%s] start", config_path)
+        try:
+            extract_cls(now, server=load_env(config_path)).run()
+        except Exception as e:
+            log.error("server [%s] error, %s,\n%s", config_path, e, traceback.format_exc())
+            return False
+        log.info("server [%s] end, use %ss", config_path, time.time() - start)
+        return True
 
-        props_start_dt = Util.timestamp_datetime(float(props_start))
-        log.info("Props success, update props_start to %s(%s)" % (props_start, props_start_dt))
+    workers = int(config_option("server_workers", 4))
+    workers_pool = ThreadPool(min(workers, len(config_paths)))
+    try:
+        results = workers_pool.map(run_server, config_paths)
+    finally:
+        workers_pool.close()
+        workers_pool.join()
+    log.info("servers: %s, failed: %s", len(config_paths), results.count(False))
 
 
 def main():
+    """python data.py b|c [区服config.ini ...], 不指定区服时抽取本目录config.ini对应的区服
+    python data.py text 列式文件 输出文件, 列式输出转换为文本格式
+    python data.py binlog [区服config.ini], 读取binlog持续抽取, 见Binlog
+    """
     now = int(time.time()) - 60
     try:
         run_type = sys.argv[1]
+        if run_type == "text":
+            Columnar.to_text(sys.argv[2], sys.argv[3])
+            return
+        if run_type == "binlog":
+            server = load_env(os.path.realpath(sys.argv[2])) if len(sys.argv) > 2 else None
+            Binlog(server).run()
+            return
+        config_paths = [os.path.realpath(path) for path in sys.argv[2:]]
 
         if run_type == "b":
-            extract = Extract(now)
-            extract.run()
+            extract_cls = Extract
         elif run_type == "c":
-            conextract = ConsumeExtract(now)
-            conextract.run()
+            extract_cls = ConsumeExtract
         else:
             sys.exit(2)
+
+        if config_paths:
+            run_servers(extract_cls, config_paths, now)
+        else:
+            extract_cls(now).run()
     except Exception as e:
         log.error("time: %s(%s) error, %s,\n%s", now, Util.timestamp_datetime(now), e, traceback.format_exc())
 
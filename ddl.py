@@ -1,9 +1,11 @@
 # coding=utf8
 
+import threading
 from functools import partial
 
 import torndb
 
+import pool
 import config
 from log import log
 
@@ -16,20 +18,22 @@ class DDL(object):
     TABLES = {}
     OLD_TABLES = {}
     NEW_TABLES = {}
-    CONNECTIONS = {}
+    CONNECTIONS = {}    # db -> pool.Pool, 多线程共用
+    LOCK = threading.Lock()
 
     @classmethod
     def connection(cls, db):
         """默认为统计的库
         db config.DB_ANALYSE, config.DB_STORE
+        返回连接池, 方法与torndb.Connection相同, 每次调用取一个空闲连接, 读操作连接断开时重试
         """
-        if db not in cls.CONNECTIONS:
-            get = partial(config.get, db)
-            log.warning("mysql connection init, db: %s", db)
-            conn = torndb.Connection(get("host"), get("db"), user=get("user"), password=get("password"))
-            cls.CONNECTIONS[db] = conn
-            return conn
-        return cls.CONNECTIONS[db]
+        with cls.LOCK:
+            if db not in cls.CONNECTIONS:
+                get = partial(config.get, db)
+                log.warning("mysql pool init, db: %s", db)
+                factory = partial(torndb.Connection, get("host"), get("db"), user=get("user"), password=get("password"))
+                cls.CONNECTIONS[db] = pool.Pool(factory, name=db)
+            return cls.CONNECTIONS[db]
 
     @classmethod
     def execute(cls, sql, db):
@@ -247,6 +247,8 @@ ls ${{dir}}/${{target_day}} > ${{work_home}}/tmp_list
 
 for i in `cat ${{work_home}}/tmp_list`
 do
+# data.py开启compress时文件已经是压缩的
+case $i in *.gz|*.zst) continue;; esac
 /usr/bin/pigz ${{dir}}/${{target_day}}/$i
 done
 """
@@ -0,0 +1,159 @@
+# coding=utf8
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import MySQLdb
+
+"""
+torndb连接池, data.Connection和ddl.DDL共用
+
+每次调用从池中取一个空闲连接, 用完放回, 同一连接同一时间只被一个线程使用
+空闲超过ping_interval秒的连接取出前先ping, 失败则重连; 后台线程定期ping空闲连接, 避免被服务端wait_timeout断开
+幂等的读(query/get)遇到连接断开时换一个连接重试, 写操作不重试
+torndb的iter是生成器, 读取时连接已放回池中, 不提供; 流式读取用 with pool.connection() as conn 或 data.Connection.batches
+"""
+
+log = logging.getLogger("bi.pool")
+
+LOST_CODES = (
+    2006,   # MySQL server has gone away
+    2013,   # Lost connection to MySQL server during query
+    2055,   # Lost connection to MySQL server at '%s', system error
+)
+
+
+def lost(e):
+    """是否为连接断开的异常"""
+    return isinstance(e, MySQLdb.OperationalError) and bool(e.args) and e.args[0] in LOST_CODES
+
+
+class Pool(object):
+    READS = ("query", "get")
+    STREAMS = ("iter",)     # 生成器在run()放回连接之后才读取
+
+    def __init__(self, factory, max_idle=4, ping_interval=300, retries=1, name=""):
+        """factory: 创建torndb.Connection的函数
+        max_idle: 最多保留的空闲连接数, 使用中的连接数不限制(流式读取时同一线程会再取连接查询, 限制总数可能死锁)
+        """
+        self.factory = factory
+        self.max_idle = max_idle
+        self.ping_interval = ping_interval
+        self.retries = retries
+        self.name = name
+        self.lock = threading.Lock()
+        self.idle = []          # [(连接, 放回时间)], 后进先出
+        self.active = 0
+        self.keeper = None
+        self.closed = False
+
+    def create(self):
+        log.warning("mysql connection init, pool: %s, active: %s", self.name, self.active)
+        return self.factory()
+
+    def ping(self, conn):
+        try:
+            if conn._db is None:
+                conn.reconnect()
+            else:
+                conn._db.ping()
+            return True
+        except Exception as e:
+            log.warning("mysql ping error, pool: %s, error: %s", self.name, str(e))
+            return False
+
+    def acquire(self):
+        conn = None
+        with self.lock:
+            if self.idle:
+                conn, used = self.idle.pop()
+            self.active += 1
+        try:
+            if conn is None:
+                return self.create()
+            if time.time() - used >= self.ping_interval and not self.ping(conn):
+                conn.reconnect()
+            return conn
+        except Exception:
+            with self.lock:
+                self.active -= 1
+            if conn is not None:
+                conn.close()
+            raise
+
+    def release(self, conn, broken=False):
+        """broken: 连接已断开或状态未知, 直接关闭"""
+        with self.lock:
+            self.active -= 1
+            if not broken and not self.closed and len(self.idle) < self.max_idle:
+                self.idle.append((conn, time.time()))
+                conn = None
+        if conn is not None:
+            conn.close()
+        self.start_keepalive()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except Exception as e:
+            broken = lost(e)
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def run(self, func, retry=False):
+        """func(conn), retry时连接断开后换连接重试retries次"""
+        attempt = 0
+        while True:
+            try:
+                with self.connection() as conn:
+                    return func(conn)
+            except Exception as e:
+                if not retry or attempt >= self.retries or not lost(e):
+                    raise
+                attempt += 1
+                log.warning("mysql connection lost, pool: %s, retry %s, error: %s", self.name, attempt, str(e))
+
+    def __getattr__(self, name):
+        """与torndb.Connection相同的query/get/execute...方法"""
+        if name in self.STREAMS:
+            raise AttributeError("Pool.{0} is not supported, use Pool.connection()".format(name))
+
+        def call(*args, **kwargs):
+            return self.run(lambda conn: getattr(conn, name)(*args, **kwargs), retry=name in self.READS)
+        return call
+
+    def start_keepalive(self):
+        if self.ping_interval <= 0 or self.keeper is not None:
+            return
+        with self.lock:
+            if self.keeper is not None:
+                return
+            self.keeper = threading.Thread(target=self.keepalive, name="pool-keepalive-%s" % self.name)
+            self.keeper.daemon = True
+        self.keeper.start()
+
+    def keepalive(self):
+        """ping空闲超过ping_interval的连接, 失败的关闭"""
+        while not self.closed:
+            time.sleep(self.ping_interval / 2.0)
+            now = time.time()
+            with self.lock:
+                stale = [conn for conn, used in self.idle if now - used >= self.ping_interval]
+                self.idle = [(conn, used) for conn, used in self.idle if now - used < self.ping_interval]
+                self.active += len(stale)
+            for conn in stale:
+                self.release(conn, broken=not self.ping(conn))
+
+    def close(self):
+        """关闭空闲连接, 使用中的连接放回时关闭"""
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for conn, used in idle:
+            conn.close()